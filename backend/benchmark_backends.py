@@ -0,0 +1,111 @@
+"""Сравнение бэкендов инференса Whisper (fp32 / int8) на CPU.
+
+Пример:
+    python benchmark_backends.py sample1.wav sample2.mp4 --models base medium --threads 4
+
+Для каждой пары модель/бэкенд выводит время загрузки, время транскрипции,
+коэффициент реального времени (RTF), размер весов и WER относительно эталона.
+Эталон — текстовый файл рядом с аудио (<имя>.txt) или, если его нет, вывод fp32.
+В конце печатаются отношения int8/fp32 для SITESUB_INT8_RAM_FACTOR и
+SITESUB_INT8_RTF_FACTOR.
+"""
+import argparse
+import io
+import os
+import time
+
+# Не загружаем модели по умолчанию при импорте main
+os.environ.setdefault("SITESUB_PRELOAD_MODELS", "")
+
+import main
+
+
+def word_error_rate(reference, hypothesis):
+    ref = reference.lower().split()
+    hyp = hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_word != hyp_word),
+            )
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    main.torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+def load_reference(media_path):
+    reference_path = os.path.splitext(media_path)[0] + ".txt"
+    if os.path.exists(reference_path):
+        with open(reference_path, encoding="utf-8") as f:
+            return f.read()
+    return None
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("media", nargs="+")
+    parser.add_argument("--models", nargs="+", default=["base"])
+    parser.add_argument("--backends", nargs="+", default=list(main.WHISPER_BACKENDS))
+    parser.add_argument("--language", default="ru")
+    parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args()
+
+    main.configure_torch_threads(args.threads, None)
+
+    rows = []
+    for model_size in args.models:
+        fp32_texts = {}
+        for backend in args.backends:
+            started = time.monotonic()
+            model = main.load_whisper_model(model_size, backend)
+            load_seconds = time.monotonic() - started
+            weights_mb = model_size_mb(model)
+            options = {"fp16": False} if backend == "int8" else {}
+
+            for media_path in args.media:
+                duration = main.probe_media_duration(media_path) or 0.0
+                started = time.monotonic()
+                result = model.transcribe(media_path, language=args.language, **options)
+                elapsed = time.monotonic() - started
+                text = result.get("text", "")
+                if backend == "fp32":
+                    fp32_texts[media_path] = text
+
+                reference = load_reference(media_path) or fp32_texts.get(media_path)
+                wer = word_error_rate(reference, text) if reference is not None else None
+                rows.append((model_size, backend, os.path.basename(media_path), load_seconds,
+                             weights_mb, elapsed, elapsed / duration if duration else None, wer))
+            del model
+
+    print(f"{'model':<8} {'backend':<7} {'media':<24} {'load,s':>7} {'MB':>7} {'time,s':>8} {'RTF':>6} {'WER':>6}")
+    for model_size, backend, media, load_seconds, weights_mb, elapsed, rtf, wer in rows:
+        rtf_str = f"{rtf:.3f}" if rtf is not None else "-"
+        wer_str = f"{wer:.3f}" if wer is not None else "-"
+        print(f"{model_size:<8} {backend:<7} {media[:24]:<24} {load_seconds:>7.1f} {weights_mb:>7.0f} "
+              f"{elapsed:>8.1f} {rtf_str:>6} {wer_str:>6}")
+
+    # Отношения int8/fp32 по каждой модели: суммарное время и размер весов
+    for model_size in args.models:
+        totals = {}
+        for row in rows:
+            if row[0] == model_size:
+                elapsed = totals.get(row[1], (0.0, 0.0))[1]
+                totals[row[1]] = (row[4], elapsed + row[5])
+        if "fp32" in totals and "int8" in totals and all(totals["fp32"]):
+            print(f"{model_size}: int8/fp32 RAM {totals['int8'][0] / totals['fp32'][0]:.2f}, "
+                  f"RTF {totals['int8'][1] / totals['fp32'][1]:.2f}")
+
+
+if __name__ == "__main__":
+    main_benchmark()
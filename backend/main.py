@@ -2,9 +2,10 @@ import os
 import tempfile
 import time
 import subprocess
+import torch
 import whisper
 import numpy as np
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, g, request, jsonify, send_file
 from flask_cors import CORS
 from moviepy.editor import VideoFileClip
 from resemblyzer import VoiceEncoder, preprocess_wav
@@ -19,24 +20,34 @@ import hashlib
 import mimetypes
 import uuid
 import subprocess
+import contextlib
+import dataclasses
+import math
+import mmap
+import json
+import re
+import wave
+import zlib
+import base64
+from collections import deque
 from werkzeug.utils import secure_filename
 import shlex  
+import gc
+import signal
+import selectors
+from werkzeug.serving import make_server
 
-def delayed_delete(path, delay=10):
-    def delete_task():
-        for _ in range(5):
-            try:
-                if os.path.exists(path):
-                    shutil.rmtree(path, ignore_errors=True)
-                    logger.info(f"Объект удалён: {path}")
-                    break
-            except Exception as e:
-                logger.warning(f"Ошибка удаления {path}, попытка {_+1}: {str(e)}")
-                time.sleep(delay * (_ + 1))
-    
-    thread = threading.Thread(target=delete_task)
-    thread.daemon = True
-    thread.start()
+try:
+    # Межпроцессная блокировка общего состояния; на Windows prefork недоступен
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Ответы в формате application/x-msgpack; без пакета доступен только JSON
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Расширенная настройка логирования
 logging.basicConfig(
@@ -57,33 +68,258 @@ SUPPORTED_LANGUAGES = ['af', 'ar', 'hy', 'az', 'be', 'bs', 'bg', 'ca', 'zh', 'hr
 
 # Инициализация Flask
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
+CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=["Retry-After"])
 
 app.config['MAX_CONTENT_LENGTH'] = 5000 * 1024 * 1024
 
+# Контроль допуска тяжёлых задач (транскрипция, наложение субтитров)
+ADMISSION_RAM_BUDGET_MB = int(os.environ.get("SITESUB_RAM_BUDGET_MB", 8192))
+ADMISSION_CPU_BUDGET = int(os.environ.get("SITESUB_CPU_BUDGET", os.cpu_count() or 4))
+ADMISSION_MAX_QUEUE = int(os.environ.get("SITESUB_MAX_QUEUE", 8))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("SITESUB_QUEUE_TIMEOUT", 300))
+ADMISSION_CLIENT_MAX_JOBS = int(os.environ.get("SITESUB_CLIENT_MAX_JOBS", 2))
+# Индивидуальные квоты клиентов: "client_a=4,client_b=1"
+ADMISSION_CLIENT_QUOTAS = os.environ.get("SITESUB_CLIENT_QUOTAS", "")
+# Заголовок X-Client-Id учитывается только от доверенных адресов (API-шлюз, прокси):
+# "127.0.0.1,10.0.0.5". Для остальных клиент определяется по адресу подключения
+ADMISSION_TRUSTED_PROXIES = {addr.strip() for addr in os.environ.get("SITESUB_TRUSTED_PROXIES", "").split(",") if addr.strip()}
+# Длительность, которую предполагаем, если ffprobe не смог её определить
+ADMISSION_UNKNOWN_DURATION = float(os.environ.get("SITESUB_UNKNOWN_DURATION", 600))
+
+# Рабочее пространство для временных файлов (можно вынести на tmpfs/NVMe)
+SCRATCH_ROOT = os.environ.get("SITESUB_SCRATCH_ROOT", os.path.join(tempfile.gettempdir(), "sitesub-scratch"))
+SCRATCH_QUOTA_MB = int(os.environ.get("SITESUB_SCRATCH_QUOTA_MB", 20480))
+# Максимальное время жизни рабочего каталога; по истечении его удалит уборщик
+SCRATCH_TTL = float(os.environ.get("SITESUB_SCRATCH_TTL", 6 * 3600))
+SCRATCH_JANITOR_INTERVAL = float(os.environ.get("SITESUB_SCRATCH_JANITOR_INTERVAL", 30))
+# Несжатое моно 16 кГц 16 бит: 32 КБ на секунду
+SCRATCH_AUDIO_BYTES_PER_SECOND = 32000
+
+# Диакризация: окно и шаг эмбеддингов голоса. В адаптивном режиме файл
+# сначала проходится с грубым шагом, а мелкий шаг используется только
+# вокруг возможных смен спикера
+DIARIZATION_MODES = ("fixed", "adaptive")
+DIARIZATION_MODE = os.environ.get("SITESUB_DIARIZATION_MODE", "fixed")
+DIARIZATION_WINDOW = 1.0
+DIARIZATION_STEP = 0.25
+DIARIZATION_COARSE_STEP = 1.0
+# Смену спикера ищем там, где расстояние между соседними эмбеддингами во столько раз
+# больше медианы соседних пар. Абсолютный порог не годится: эмбеддинги Resemblyzer
+# неотрицательны, и косинусные расстояния сжаты в узкий диапазон, зависящий от записи
+DIARIZATION_CHANGE_RATIO = float(os.environ.get("SITESUB_DIARIZATION_CHANGE_RATIO", 1.3))
+DIARIZATION_CHANGE_CONTEXT = 8
+
+# Структурированные ответы с сегментами хранятся для постраничной выдачи
+RESULTS_TTL = float(os.environ.get("SITESUB_RESULTS_TTL", 3600))
+SEGMENTS_PAGE_SIZE = int(os.environ.get("SITESUB_SEGMENTS_PAGE_SIZE", 500))
+SEGMENTS_MAX_PAGE_SIZE = 5000
+# Сколько сегментов сериализуется за один фрагмент потокового ответа
+STREAM_CHUNK_SEGMENTS = 200
+SUBTITLE_MIMETYPES = {"srt": "application/x-subrip", "vtt": "text/vtt", "txt": "text/plain"}
+
+# Профили стоимости задач: базовая RAM (МБ), число занимаемых ядер и
+# начальный коэффициент реального времени (секунд обработки на секунду медиа).
+# Коэффициент уточняется по фактическим замерам после каждой задачи.
+JOB_PROFILES = {
+    "tiny":    {"ram_mb": 600,   "cpu": 1, "rtf": 0.10},
+    "base":    {"ram_mb": 1000,  "cpu": 2, "rtf": 0.20},
+    "small":   {"ram_mb": 2000,  "cpu": 2, "rtf": 0.50},
+    "medium":  {"ram_mb": 5000,  "cpu": 4, "rtf": 1.20},
+    "large":   {"ram_mb": 10000, "cpu": 4, "rtf": 2.50},
+    "burn_in": {"ram_mb": 800,   "cpu": 2, "rtf": 0.60},
+    # Эмбеддинги голоса считаются параллельно с транскрипцией в своих потоках
+    # torch; их RAM и ядра добавляются к стоимости каждой транскрипции
+    "diarization": {"ram_mb": 300, "cpu": 2, "rtf": 0.10},
+}
+# Бэкенд int8 экспериментальный: поправки к профилю не измерены, поэтому по
+# умолчанию он оценивается как fp32. Значения стоит задать по результатам
+# benchmark_backends.py на целевом железе. Коэффициент реального времени
+# int8-моделей затем уточняется по фактическим замерам, память — нет.
+INT8_RAM_FACTOR = float(os.environ.get("SITESUB_INT8_RAM_FACTOR", 1.0))
+INT8_RTF_FACTOR = float(os.environ.get("SITESUB_INT8_RTF_FACTOR", 1.0))
+
+# Бэкенды инференса Whisper на CPU
+WHISPER_BACKENDS = ("fp32", "int8")
+PRELOAD_MODELS = os.environ.get("SITESUB_PRELOAD_MODELS", "base,medium")
+TORCH_THREADS = int(os.environ.get("SITESUB_TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.environ.get("SITESUB_TORCH_INTEROP_THREADS", 0))
+
+# Режим сервера: "dev" — встроенный сервер Flask, "prefork" — мастер-процесс
+# загружает модели и порождает воркеры, разделяющие веса copy-on-write
+SERVER_MODE = os.environ.get("SITESUB_SERVER_MODE", "dev")
+SERVER_HOST = os.environ.get("SITESUB_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SITESUB_PORT", 5000))
+SERVER_WORKERS = int(os.environ.get("SITESUB_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Воркер перезапускается после N запросов или по истечении времени жизни (0 — без ограничения)
+WORKER_MAX_REQUESTS = int(os.environ.get("SITESUB_WORKER_MAX_REQUESTS", 500))
+WORKER_MAX_AGE = float(os.environ.get("SITESUB_WORKER_MAX_AGE", 0))
+# Аудио 16 кГц float32 в памяти: ~64 КБ на секунду
+JOB_RAM_MB_PER_SECOND = 0.0625
+
 # Глобальная загрузка моделей (кеширование)
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL_CACHE_DIR = os.environ.get("SITESUB_MODEL_CACHE_DIR", os.path.join(APP_ROOT, "model_cache"))
+
+# Кеш последних рендеров для инкрементального повторного экспорта
+# Лежит под корнем рабочего пространства: учитывается в его квоте, а рендер
+# из рабочего каталога попадает в кеш жёсткой ссылкой, без копирования
+RENDER_CACHE_DIR = os.environ.get("SITESUB_RENDER_CACHE_DIR", os.path.join(SCRATCH_ROOT, "render_cache"))
+RENDER_CACHE_MAX_ENTRIES = int(os.environ.get("SITESUB_RENDER_CACHE_MAX_ENTRIES", 5))
+RENDER_CACHE_MAX_MB = int(os.environ.get("SITESUB_RENDER_CACHE_MAX_MB", SCRATCH_QUOTA_MB // 4))
+# Ключевые кадры рендера ставятся строго через этот интервал, по ним режем видео
+RENDER_GOP_SECONDS = float(os.environ.get("SITESUB_RENDER_GOP_SECONDS", 2.0))
+# Если изменилась большая часть видео, быстрее перекодировать его целиком
+INCREMENTAL_MAX_CHANGED_FRACTION = 0.5
+# Нарезка и склейка без перекодирования: доля стоимости полного рендера на секунду видео
+INCREMENTAL_COPY_FACTOR = 0.05
+BURN_IN_VIDEO_ARGS = [
+    '-c:v', 'libx264',
+    '-preset', 'veryfast',
+    '-crf', '23',
+    '-force_key_frames', f"expr:gte(t,n_forced*{RENDER_GOP_SECONDS})",
+    # Единая шкала времени, чтобы куски рендеров склеивались без перекодирования
+    '-video_track_timescale', '90000',
+]
 encoder = VoiceEncoder()
 models = {}
+models_lock = threading.Lock()
 
 # Импорт sampling_rate из resemblyzer.hparams
 from resemblyzer.hparams import sampling_rate
 
+def configure_torch_threads(intra_threads=None, interop_threads=None):
+    """Задаёт число потоков torch для текущего процесса (0 — значение по умолчанию)."""
+    intra_threads = TORCH_THREADS if intra_threads is None else intra_threads
+    interop_threads = TORCH_INTEROP_THREADS if interop_threads is None else interop_threads
+    if intra_threads > 0:
+        torch.set_num_threads(intra_threads)
+    if interop_threads > 0:
+        # Допустимо только до первой параллельной операции в процессе
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logger.warning(f"Не удалось изменить число inter-op потоков torch: {str(e)}")
+    logger.info(f"Потоки torch: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+def resolve_model_key(model_size, backend=None):
+    """Разбирает "base-int8" / ("base", "int8") в (размер, бэкенд, ключ кеша моделей)."""
+    size = model_size
+    for name in WHISPER_BACKENDS:
+        if model_size.endswith(f"-{name}"):
+            size = model_size[:-len(name) - 1]
+            backend = backend or name
+    if backend not in WHISPER_BACKENDS:
+        if backend:
+            logger.warning(f"Неизвестный бэкенд '{backend}'. Используем fp32")
+        backend = "fp32"
+    key = size if backend == "fp32" else f"{size}-{backend}"
+    return size, backend, key
+
+def _replace_whisper_linear(module):
+    # whisper.model.Linear — подкласс nn.Linear, который quantize_dynamic
+    # не распознаёт; на CPU в fp32 он эквивалентен обычному nn.Linear
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+            plain = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            plain.load_state_dict(child.state_dict())
+            setattr(module, name, plain)
+        else:
+            _replace_whisper_linear(child)
+
+def quantized_model_path(model_size):
+    # Кеш привязан к версиям torch и whisper и к контрольной сумме исходных
+    # весов (SHA256 зашит в URL модели), чтобы обновление не подхватило старые веса
+    torch_version = torch.__version__.split("+")[0]
+    whisper_version = getattr(whisper, "__version__", "unknown")
+    model_url = getattr(whisper, "_MODELS", {}).get(model_size, "")
+    checksum = model_url.split("/")[-2][:16] if model_url.count("/") >= 2 else "unknown"
+    return os.path.join(MODEL_CACHE_DIR, f"whisper-{model_size}-{checksum}-int8-"
+                                         f"whisper{whisper_version}-torch{torch_version}.state.pt")
+
+def _quantize_whisper(model):
+    _replace_whisper_linear(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _load_quantized_state(cache_path, model_size):
+    # В кеше только тензоры, поэтому он читается с weights_only=True, а структура
+    # модели собирается заново: скелет Whisper, та же замена слоёв и квантизация
+    checkpoint = torch.load(cache_path, map_location="cpu", weights_only=True)
+    model = _quantize_whisper(whisper.model.Whisper(whisper.model.ModelDimensions(**checkpoint["dims"])))
+    model.load_state_dict(checkpoint["state_dict"])
+    # Головы выравнивания — непостоянный буфер, в state_dict их нет
+    alignment_heads = getattr(whisper, "_ALIGNMENT_HEADS", {}).get(model_size)
+    if alignment_heads is not None:
+        model.set_alignment_heads(alignment_heads)
+    return model
+
+def load_quantized_model(model_size):
+    """Whisper с динамической int8-квантизацией линейных слоёв, с кешем на диске.
+
+    Бэкенд экспериментальный: выигрыш по скорости, памяти и WER не измерен.
+    """
+    logger.warning(f"Бэкенд int8 экспериментальный: модель {model_size}")
+    cache_path = quantized_model_path(model_size)
+    if os.path.exists(cache_path):
+        try:
+            model = _load_quantized_state(cache_path, model_size)
+            logger.info(f"Квантизованная модель загружена из кеша: {cache_path}")
+            return model.eval()
+        except Exception as e:
+            logger.warning(f"Кеш квантизованной модели повреждён ({cache_path}): {str(e)}")
+
+    started = time.monotonic()
+    model = _quantize_whisper(whisper.load_model(model_size, device="cpu"))
+    model.eval()
+    logger.info(f"Модель {model_size} квантизована в int8 за {time.monotonic() - started:.1f} с")
+
+    try:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        torch.save({"dims": dataclasses.asdict(model.dims), "state_dict": model.state_dict()}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"Квантизованная модель сохранена в кеш: {cache_path}")
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить кеш квантизованной модели: {str(e)}")
+    return model
+
+def load_whisper_model(model_size, backend="fp32"):
+    if backend == "int8":
+        return load_quantized_model(model_size)
+    return whisper.load_model(model_size)
+
+def get_model(model_size, backend=None):
+    size, backend, key = resolve_model_key(model_size, backend)
+    model = models.get(key)
+    if model is None:
+        with models_lock:
+            model = models.get(key)
+            if model is None:
+                logger.info(f"Загружаю модель Whisper: {key}")
+                model = load_whisper_model(size, backend)
+                models[key] = model
+    return model, backend
+
 def load_models():
     logger.info("Предварительная загрузка моделей Whisper...")
-    model_sizes = ["base", "medium"]
+    model_keys = [resolve_model_key(name.strip()) for name in PRELOAD_MODELS.split(",") if name.strip()]
     
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(whisper.load_model, size): size for size in model_sizes}
+        futures = {executor.submit(load_whisper_model, size, backend): key for size, backend, key in model_keys}
         
         for future in concurrent.futures.as_completed(futures):
-            model_size = futures[future]
+            model_key = futures[future]
             try:
-                models[model_size] = future.result()
-                logger.info(f"Загружена модель Whisper: {model_size}")
+                models[model_key] = future.result()
+                logger.info(f"Загружена модель Whisper: {model_key}")
             except Exception as e:
-                logger.error(f"Ошибка загрузки модели {model_size}: {str(e)}")
+                logger.error(f"Ошибка загрузки модели {model_key}: {str(e)}")
 
+if SERVER_MODE == "prefork":
+    # В мастере torch работает в один поток: пул потоков OpenMP, созданный
+    # до fork(), в дочерних процессах не работает. Воркеры настраивают потоки сами.
+    torch.set_num_threads(1)
+else:
+    configure_torch_threads()
 load_models()
 
 def validate_file(file_stream):
@@ -110,64 +346,33 @@ def validate_file(file_stream):
         logger.error(f"Ошибка валидации файла: {str(e)}")
     return None
 
-def extract_audio(video_stream, audio_path):
+def extract_audio(video_path, audio_path):
     try:
-        # Создаем уникальное имя для временного файла
-        temp_video_name = f"temp_{uuid.uuid4().hex}.mp4"
-        temp_video_path = os.path.join(tempfile.gettempdir(), temp_video_name)
+        # Извлекаем аудио с помощью FFmpeg
+        ffmpeg_path = "ffmpeg"
         
-        # Сохраняем видеофайл
-        with open(temp_video_path, 'wb') as f:
-            video_stream.save(f)
-            
-        logger.info(f"Временный видеофайл сохранён: {temp_video_path}")
+        command = [
+            ffmpeg_path,
+            "-i", video_path,
+            "-vn",             
+            "-acodec", "pcm_s16le",  
+            "-ar", str(sampling_rate),  
+            "-ac", "1",         
+            "-y",               
+            audio_path
+        ]
         
-        # Извлекаем аудио с помощью FFmpeg
-        try:
-            # Находим путь к FFmpeg
-            ffmpeg_path = "ffmpeg"
-            
-            command = [
-                ffmpeg_path,
-                "-i", temp_video_path,
-                "-vn",             
-                "-acodec", "pcm_s16le",  
-                "-ar", str(sampling_rate),  
-                "-ac", "1",         
-                "-y",               
-                audio_path
-            ]
-            
-            logger.info(f"Выполняем команду извлечения: {' '.join(command)}")
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if result.returncode != 0:
-                error_message = result.stderr.decode('utf-8')
-                logger.error(f"Ошибка FFmpeg при извлечении аудио: {error_message}")
-                raise RuntimeError(f"FFmpeg error: {error_message}")
-                
-            logger.info(f"Аудиофайл успешно извлечён: {audio_path} - размер: {os.path.getsize(audio_path)} байт")
-            
-            return audio_path
-        finally:
-            # Гарантированное удаление временного файла с повторными попытками
-            def safe_delete(path, max_attempts=5, delay=0.2):
-                for attempt in range(max_attempts):
-                    try:
-                        if os.path.exists(path):
-                            os.remove(path)
-                            logger.info(f"Удалён временный файл: {path}")
-                            return True
-                    except PermissionError as pe:
-                        logger.warning(f"Попытка {attempt+1}/{max_attempts}: файл занят, повтор через {delay}сек")
-                        time.sleep(delay)
-                    except Exception as e:
-                        logger.error(f"Неожиданная ошибка при удалении: {str(e)}")
-                        return False
-                logger.error(f"Не удалось удалить {path} после {max_attempts} попыток")
-                return False
+        logger.info(f"Выполняем команду извлечения: {' '.join(command)}")
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        if result.returncode != 0:
+            error_message = result.stderr.decode('utf-8')
+            logger.error(f"Ошибка FFmpeg при извлечении аудио: {error_message}")
+            raise RuntimeError(f"FFmpeg error: {error_message}")
             
-            safe_delete(temp_video_path)
+        logger.info(f"Аудиофайл успешно извлечён: {audio_path} - размер: {os.path.getsize(audio_path)} байт")
+        
+        return audio_path
                 
     except Exception as e:
         logger.error(f"Ошибка извлечения аудио: {str(e)}", exc_info=True)
@@ -179,16 +384,718 @@ def extract_audio(video_stream, audio_path):
                 pass
         raise
 
-def transcribe_audio(audio_path, model_size="base", language=None, translate=False):
+def wav_duration(audio_path):
+    with contextlib.closing(wave.open(audio_path, 'rb')) as wav_file:
+        return wav_file.getnframes() / float(wav_file.getframerate())
+
+def probe_media_duration(media_path):
+    """Длительность медиафайла в секундах по данным ffprobe (None, если не удалось)."""
+    command = [
+        "ffprobe",
+        "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        media_path
+    ]
     try:
-        model = models.get(model_size)
-        if not model:
-            logger.info(f"Загружаю модель Whisper: {model_size}")
-            model = whisper.load_model(model_size)
-            models[model_size] = model
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=30)
+        if result.returncode != 0:
+            logger.warning(f"ffprobe не смог прочитать {media_path}: {result.stderr.strip()[:200]}")
+            return None
+        duration = float(result.stdout.strip())
+        return duration if duration > 0 else None
+    except (ValueError, subprocess.TimeoutExpired, OSError) as e:
+        logger.warning(f"Не удалось определить длительность {media_path}: {str(e)}")
+        return None
+
+class SharedState:
+    """Небольшое JSON-состояние в анонимной разделяемой памяти.
+
+    Создаётся при импорте, то есть в мастере до fork(), поэтому все воркеры
+    prefork работают с одним состоянием. Читать и менять его можно только
+    внутри locked(). Между процессами блокировка — flock на lock_path: ядро
+    снимает её, если процесс убит. Запись идёт в неактивную половину буфера,
+    после чего она становится активной, поэтому прерванная запись не портит
+    состояние. Ожидающие изменений других процессов опрашивают его.
+    """
+
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, initial, lock_path, size=1024 * 1024):
+        self.lock_path = lock_path
+        self._slot_size = size
+        self._buffer = mmap.mmap(-1, 1 + 2 * size)
+        self._lock_fd = None
+        self._lock_pid = None
+        self._reset_thread_lock()
+        if hasattr(os, "register_at_fork"):
+            # Блокировку потоков мог держать другой поток родителя в момент fork()
+            os.register_at_fork(after_in_child=self._reset_thread_lock)
+        with self.locked():
+            self.store(initial)
+
+    def _reset_thread_lock(self):
+        self._cond = threading.Condition()
+
+    def _file_lock(self, exclusive):
+        if fcntl is None:
+            return
+        # Дескриптор открывается в каждом процессе свой: унаследованный после
+        # fork() разделял бы блокировку с родителем
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self._cond:
+            self._file_lock(True)
+            try:
+                yield
+            finally:
+                self._file_lock(False)
+
+    def wait(self, timeout):
+        """Отпускает блокировку до уведомления в этом процессе или до следующего опроса."""
+        self._file_lock(False)
+        try:
+            self._cond.wait(min(timeout, self.POLL_INTERVAL))
+        finally:
+            self._file_lock(True)
+
+    def notify_all(self):
+        self._cond.notify_all()
+
+    def load(self):
+        start = 1 + self._buffer[0] * self._slot_size
+        length = int.from_bytes(self._buffer[start:start + 4], "little")
+        return json.loads(self._buffer[start + 4:start + 4 + length])
+
+    def store(self, state):
+        data = json.dumps(state, separators=(",", ":")).encode("utf-8")
+        if len(data) + 4 > self._slot_size:
+            raise RuntimeError("Shared state does not fit into its buffer")
+        slot = 1 - self._buffer[0]
+        start = 1 + slot * self._slot_size
+        self._buffer[start:start + 4] = len(data).to_bytes(4, "little")
+        self._buffer[start + 4:start + 4 + len(data)] = data
+        self._buffer[0] = slot
+
+class ScratchManager:
+    """Рабочие каталоги для временных файлов запросов.
+
+    Каждый каталог создаётся под общим корнем и содержит файл аренды
+    (.lease) с pid владельца и сроком действия. Один фоновый поток-уборщик
+    удаляет каталоги с истёкшей арендой, каталоги умерших процессов и
+    остатки после аварий, поэтому аренда видна всем процессам prefork.
+
+    Занятое место считается по кешу, который уборщик пересчитывает при
+    каждом обходе, плюс резервы под ещё не записанные файлы: загрузки
+    (их временные файлы удалены из каталога и не видны при обходе),
+    извлечённое аудио и рендеры допущенных задач. Кеш и резервы лежат в
+    SharedState и общие для всех воркеров.
+    """
+
+    LEASE_FILE = ".lease"
+    UPLOADS_DIR = "uploads"
+
+    def __init__(self, root, quota_bytes, ttl, janitor_interval, persistent_dirs=()):
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.ttl = ttl
+        self.janitor_interval = janitor_interval
+        self.uploads_dir = os.path.join(self.root, self.UPLOADS_DIR)
+        # Каталоги без аренды, которые уборщик не трогает (загрузки, кеш рендеров)
+        self.persistent_dirs = {self.uploads_dir} | {os.path.abspath(path) for path in persistent_dirs}
+        self._lock = threading.Lock()
+        self._owned = set()
+        self._janitor_pid = None
+        self._reclaimed_bytes = 0
+        self._reclaimed_count = 0
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        usage, counted = self._measure()
+        self._shared = SharedState({"usage": usage, "counted": counted, "reserved": {}},
+                                   lock_path=os.path.join(self.root, ".scratch.lock"), size=256 * 1024)
+        self.janitor_enabled = True
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Блокировку мог держать поток уборщика мастера в момент fork()
+        self._lock = threading.Lock()
+        self._owned = set()
+
+    def _write_lease(self, path, expires, detached):
+        lease = {"owner": os.getpid(), "expires": expires, "detached": detached}
+        tmp_path = os.path.join(path, f"{self.LEASE_FILE}.{uuid.uuid4().hex}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(lease, f)
+        os.replace(tmp_path, os.path.join(path, self.LEASE_FILE))
+
+    def _read_lease(self, path):
+        try:
+            with open(os.path.join(path, self.LEASE_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def create(self, prefix, ttl=None, detached=False):
+        """Создаёт рабочий каталог. detached=True — каталог переживает процесс-владелец."""
+        self.start_janitor()
+        path = os.path.join(self.root, f"{prefix}-{uuid.uuid4().hex}")
+        os.makedirs(path)
+        self._write_lease(path, time.time() + (ttl or self.ttl), detached)
+        with self._lock:
+            self._owned.add(path)
+        logger.info(f"Создан рабочий каталог: {path}")
+        return path
+
+    def path_for(self, name):
+        """Путь к существующему рабочему каталогу по имени (None, если его нет)."""
+        if not name or os.sep in name or (os.altsep and os.altsep in name) or name.startswith("."):
+            return None
+        path = os.path.join(self.root, name)
+        return path if path not in self.persistent_dirs and os.path.isdir(path) else None
+
+    def extend(self, path, ttl):
+        lease = self._read_lease(path) or {}
+        self._write_lease(path, time.time() + ttl, lease.get("detached", False))
+
+    def release(self, path):
+        """Освобождает каталог; если удалить сразу не вышло, его доберёт уборщик."""
+        with self._lock:
+            self._owned.discard(path)
+        if not self._remove(path):
+            with contextlib.suppress(OSError):
+                self._write_lease(path, 0, False)
+
+    @contextlib.contextmanager
+    def workspace(self, prefix, ttl=None):
+        path = self.create(prefix, ttl)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def _remove(self, path):
+        size = self._tree_size(path)
+        try:
+            shutil.rmtree(path)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {path}: {str(e)}")
+            return False
+        with self._lock:
+            self._reclaimed_bytes += size
+            self._reclaimed_count += 1
+        # Вычитаем только то, что учёл последний обход: каталог, созданный после
+        # него, в кеше занятого места ещё не числится
+        with self._shared.locked():
+            state = self._shared.load()
+            counted = state["counted"].pop(os.path.basename(path), 0)
+            state["usage"] = max(0, state["usage"] - counted)
+            self._shared.store(state)
+        logger.info(f"Объект удалён: {path}")
+        return True
+
+    @staticmethod
+    def _tree_size(path):
+        total = 0
+        stack = [path]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            else:
+                                total += entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+        return total
+
+    @staticmethod
+    def _pid_alive(pid):
+        # os.kill(pid, 0) на Windows завершает процесс, поэтому проверяем только на POSIX
+        if os.name != "posix":
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _measure(self):
+        """Полный обход: (занято байт, размеры рабочих каталогов по именам)."""
+        usage = 0
+        counted = {}
+        with contextlib.suppress(FileNotFoundError), os.scandir(self.root) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        size = self._tree_size(entry.path)
+                        if entry.path not in self.persistent_dirs:
+                            counted[entry.name] = size
+                    else:
+                        size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+                usage += size
+        return usage, counted
+
+    def refresh_usage(self):
+        usage, counted = self._measure()
+        with self._shared.locked():
+            state = self._shared.load()
+            state["usage"] = usage
+            state["counted"] = counted
+            self._shared.store(state)
+
+    def usage_bytes(self):
+        """Занятое место по кешу и зарезервированные байты."""
+        with self._shared.locked():
+            state = self._shared.load()
+        return state["usage"], sum(state["reserved"].values())
+
+    def has_room(self, nbytes):
+        usage, reserved = self.usage_bytes()
+        return usage + reserved + nbytes <= self.quota_bytes
+
+    def reserve(self, nbytes, force=False):
+        """Резервирует место под ещё не записанные файлы; False — не хватает квоты."""
+        with self._shared.locked():
+            state = self._shared.load()
+            if not force and state["usage"] + sum(state["reserved"].values()) + nbytes > self.quota_bytes:
+                return False
+            pid = str(os.getpid())
+            state["reserved"][pid] = state["reserved"].get(pid, 0) + nbytes
+            self._shared.store(state)
+        return True
+
+    def unreserve(self, nbytes):
+        with self._shared.locked():
+            state = self._shared.load()
+            pid = str(os.getpid())
+            remaining = state["reserved"].get(pid, 0) - nbytes
+            if remaining > 0:
+                state["reserved"][pid] = remaining
+            else:
+                state["reserved"].pop(pid, None)
+            self._shared.store(state)
+
+    def release_process(self, pid):
+        """Снимает резервы завершившегося процесса (вызывается мастером prefork)."""
+        with self._shared.locked():
+            state = self._shared.load()
+            if state["reserved"].pop(str(pid), None) is not None:
+                self._shared.store(state)
+
+    def sweep(self):
+        """Удаляет каталоги с истёкшей арендой и каталоги умерших процессов."""
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.path in self.persistent_dirs or not entry.is_dir(follow_symlinks=False):
+                continue
+            lease = self._read_lease(entry.path)
+            if lease is None:
+                # Каталог без аренды — остаток после аварии между mkdir и записью аренды
+                expired = now - entry.stat().st_mtime > self.janitor_interval
+            else:
+                expired = lease.get("expires", 0) <= now or (
+                    not lease.get("detached") and not self._pid_alive(lease.get("owner", 0))
+                )
+            if expired:
+                with self._lock:
+                    self._owned.discard(entry.path)
+                self._remove(entry.path)
+        self.refresh_usage()
+
+    def start_janitor(self):
+        # Уборщик один на сервер: в режиме prefork он работает в мастере,
+        # а в воркерах отключён (janitor_enabled = False)
+        if not self.janitor_enabled:
+            return
+        with self._lock:
+            if self._janitor_pid == os.getpid():
+                return
+            self._janitor_pid = os.getpid()
+            self._owned = set()
+        thread = threading.Thread(target=self._janitor_loop, name="scratch-janitor", daemon=True)
+        thread.start()
+
+    def _janitor_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка уборщика рабочих каталогов: {str(e)}")
+            time.sleep(self.janitor_interval)
+
+    def stats(self):
+        with self._lock:
+            owned = len(self._owned)
+            reclaimed_bytes = self._reclaimed_bytes
+            reclaimed_count = self._reclaimed_count
+        usage, reserved = self.usage_bytes()
+        return {
+            "root": self.root,
+            "bytes_in_use": usage,
+            "bytes_reserved": reserved,
+            "quota_bytes": self.quota_bytes,
+            "workspaces_owned": owned,
+            "reclaimed_bytes": reclaimed_bytes,
+            "reclaimed_workspaces": reclaimed_count,
+        }
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Допускает тяжёлые задачи в пределах бюджета CPU/RAM.
+
+    Стоимость задачи оценивается по длительности медиа и профилю модели.
+    Задачи, не помещающиеся в бюджет, ждут в очереди FIFO; при переполнении
+    очереди, слишком долгом ожидании или превышении квоты клиента
+    выбрасывается AdmissionRejected со статусом 503/429 и Retry-After.
+    Очередь, выполняемые задачи и счётчики клиентов хранятся в SharedState,
+    поэтому бюджет и квоты общие для всех воркеров prefork.
+    """
+
+    def __init__(self, ram_budget_mb, cpu_budget, max_queue, queue_timeout,
+                 client_max_jobs, client_quotas=None, scratch=None, lock_path=None):
+        self.scratch = scratch
+        self.ram_budget_mb = ram_budget_mb
+        self.cpu_budget = cpu_budget
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_max_jobs = client_max_jobs
+        self.client_quotas = client_quotas or {}
+        self._shared = SharedState({
+            "queue": [],
+            "running": {},
+            "clients": {},
+            "rtf": {kind: profile["rtf"] for kind, profile in JOB_PROFILES.items()},
+        }, lock_path=lock_path or os.path.join(tempfile.gettempdir(), "sitesub-admission.lock"))
+        self._load()
+
+    @staticmethod
+    def parse_quotas(spec):
+        quotas = {}
+        for item in spec.split(","):
+            if "=" not in item:
+                continue
+            client_id, limit = item.split("=", 1)
+            try:
+                quotas[client_id.strip()] = int(limit)
+            except ValueError:
+                logger.warning(f"Некорректная квота клиента: {item}")
+        return quotas
+
+    def _load(self):
+        state = self._shared.load()
+        self._queue = deque(state["queue"])
+        self._running = state["running"]
+        self._clients = Counter(state["clients"])
+        self._rtf = state["rtf"]
+
+    def _store(self):
+        self._shared.store({
+            "queue": list(self._queue),
+            "running": self._running,
+            "clients": dict(self._clients),
+            "rtf": self._rtf,
+        })
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Атрибуты состояния действительны только внутри этого блока
+        with self._shared.locked():
+            self._load()
+            try:
+                yield
+            finally:
+                self._store()
+
+    def _wait(self, timeout):
+        self._store()
+        self._shared.wait(timeout)
+        self._load()
+
+    def estimate(self, kind, duration, scratch_bytes=0, diarization_load=1.0):
+        if kind == "burn_in":
+            profile = JOB_PROFILES["burn_in"]
+        else:
+            size, backend, _ = resolve_model_key(kind)
+            # "large-v3", "base.en" и т. п. оцениваются по профилю семейства
+            profile = dict(JOB_PROFILES.get(re.split(r"[.-]", size)[0], JOB_PROFILES["base"]))
+            if backend == "int8":
+                profile["ram_mb"] *= INT8_RAM_FACTOR
+                profile["rtf"] *= INT8_RTF_FACTOR
+            # Транскрипция идёт вместе с расчётом эмбеддингов голоса
+            profile["ram_mb"] += JOB_PROFILES["diarization"]["ram_mb"]
+            profile["cpu"] += JOB_PROFILES["diarization"]["cpu"]
+        probed = duration is not None
+        if not probed:
+            duration = ADMISSION_UNKNOWN_DURATION
+        seconds = duration * self._rtf.get(kind, profile["rtf"])
+        if kind != "burn_in":
+            # Эмбеддинги считаются параллельно с транскрипцией; при мелком шаге они дольше её
+            seconds = max(seconds, duration * JOB_PROFILES["diarization"]["rtf"] * diarization_load)
+        return {
+            "kind": kind,
+            "duration": duration,
+            "duration_probed": probed,
+            "ram_mb": profile["ram_mb"] + duration * JOB_RAM_MB_PER_SECOND,
+            "cpu": profile["cpu"],
+            "seconds": seconds,
+            "scratch_bytes": scratch_bytes,
+            "diarization_load": diarization_load,
+        }
+
+    def _fits(self, job):
+        # Задача, превышающая весь бюджет, выполняется в одиночку на весь сервер
+        if not self._running:
+            return True
+        ram_used = sum(j["ram_mb"] for j in self._running.values())
+        cpu_used = sum(j["cpu"] for j in self._running.values())
+        return (ram_used + job["ram_mb"] <= self.ram_budget_mb
+                and cpu_used + job["cpu"] <= self.cpu_budget
+                and (self.scratch is None or self.scratch.has_room(job["scratch_bytes"])))
+
+    def _estimated_wait(self):
+        now = time.monotonic()
+        remaining = [max(0.0, j["started"] + j["seconds"] - now) for j in self._running.values()]
+        wait = min(remaining) if remaining else 0.0
+        parallel = max(1, len(self._running))
+        wait += sum(j["seconds"] for j in self._queue) / parallel
+        return wait
+
+    def _retry_after(self):
+        return int(min(3600, max(1, math.ceil(self._estimated_wait()))))
+
+    def _client_limit(self, client_id):
+        return self.client_quotas.get(client_id, self.client_max_jobs)
+
+    def _dequeue(self, job_id):
+        self._queue = deque(j for j in self._queue if j["id"] != job_id)
+
+    def _acquire(self, client_id, kind, duration, scratch_bytes=0, diarization_load=1.0):
+        with self._locked():
+            job = self.estimate(kind, duration, scratch_bytes, diarization_load)
+            job["id"] = uuid.uuid4().hex
+            job["client_id"] = client_id
+            job["pid"] = os.getpid()
+
+            if self._clients[client_id] >= self._client_limit(client_id):
+                raise AdmissionRejected(429, "Too many concurrent jobs for this client", self._retry_after())
+            if len(self._queue) >= self.max_queue:
+                raise AdmissionRejected(503, "Processing queue is full", self._retry_after())
+            if (self._queue or not self._fits(job)) and self._estimated_wait() > self.queue_timeout:
+                raise AdmissionRejected(503, "Estimated wait exceeds queue timeout", self._retry_after())
+
+            self._clients[client_id] += 1
+            self._queue.append(job)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while not (self._queue[0]["id"] == job["id"] and self._fits(job)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionRejected(503, "Timed out waiting for processing capacity", self._retry_after())
+                    self._wait(remaining)
+            except BaseException:
+                self._dequeue(job["id"])
+                self._release_client(client_id)
+                self._shared.notify_all()
+                raise
+
+            self._queue.popleft()
+            job["started"] = time.monotonic()
+            self._running[job["id"]] = job
+            if self.scratch is not None:
+                self.scratch.reserve(job["scratch_bytes"], force=True)
+            self._shared.notify_all()
+
+        logger.info(f"Задача {kind} допущена: {job['duration']:.1f} с медиа, "
+                    f"оценка {job['seconds']:.1f} с, {job['ram_mb']:.0f} МБ, {job['cpu']} ядер")
+        return job
+
+    def _release_client(self, client_id):
+        self._clients[client_id] -= 1
+        if self._clients[client_id] <= 0:
+            del self._clients[client_id]
+
+    def _release(self, job):
+        with self._locked():
+            if self._running.pop(job["id"], None) is not None:
+                self._release_client(job["client_id"])
+                if self.scratch is not None:
+                    self.scratch.unreserve(job["scratch_bytes"])
+            self._shared.notify_all()
+
+    def release_process(self, pid):
+        """Освобождает задачи процесса, завершившегося аварийно (вызывается мастером prefork)."""
+        with self._locked():
+            jobs = [j for j in self._running.values() if j["pid"] == pid]
+            jobs += [j for j in self._queue if j["pid"] == pid]
+            for job in jobs:
+                self._running.pop(job["id"], None)
+                self._dequeue(job["id"])
+                self._release_client(job["client_id"])
+            if jobs:
+                logger.warning(f"Освобождено {len(jobs)} задач завершившегося процесса {pid}")
+                self._shared.notify_all()
+
+    @contextlib.contextmanager
+    def admit(self, client_id, kind, duration, scratch_bytes=0, diarization_load=1.0):
+        job = self._acquire(client_id, kind, duration, scratch_bytes, diarization_load)
+        try:
+            yield job
+        finally:
+            self._release(job)
+
+    def observe(self, job, elapsed):
+        """Уточняет коэффициент реального времени по фактическому замеру."""
+        duration = job["duration"]
+        # Предполагаемая длительность или нестандартный шаг диакризации исказили бы коэффициент для всех задач
+        if not job["duration_probed"] or job["diarization_load"] != 1.0 or duration < 5 or elapsed <= 0:
+            return
+        with self._locked():
+            measured = elapsed / duration
+            previous = self._rtf.get(job["kind"], measured)
+            self._rtf[job["kind"]] = rtf = 0.7 * previous + 0.3 * measured
+        logger.info(f"Коэффициент реального времени {job['kind']}: {rtf:.3f}")
+
+    def stats(self):
+        with self._locked():
+            return {
+                "running": len(self._running),
+                "queued": len(self._queue),
+                "ram_used_mb": round(sum(j["ram_mb"] for j in self._running.values())),
+                "ram_budget_mb": self.ram_budget_mb,
+                "cpu_used": sum(j["cpu"] for j in self._running.values()),
+                "cpu_budget": self.cpu_budget,
+                "realtime_factors": {k: round(v, 3) for k, v in self._rtf.items()},
+            }
+
+scratch = ScratchManager(
+    root=SCRATCH_ROOT,
+    quota_bytes=SCRATCH_QUOTA_MB * 1024 * 1024,
+    ttl=SCRATCH_TTL,
+    janitor_interval=SCRATCH_JANITOR_INTERVAL,
+    persistent_dirs=[RENDER_CACHE_DIR],
+)
+
+admission = AdmissionController(
+    ram_budget_mb=ADMISSION_RAM_BUDGET_MB,
+    cpu_budget=ADMISSION_CPU_BUDGET,
+    max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    client_max_jobs=ADMISSION_CLIENT_MAX_JOBS,
+    client_quotas=AdmissionController.parse_quotas(ADMISSION_CLIENT_QUOTAS),
+    scratch=scratch,
+    lock_path=os.path.join(SCRATCH_ROOT, ".admission.lock"),
+)
+
+class ScratchRequest(Request):
+    # Загружаемые файлы буферизуются в рабочем пространстве, а не в системном temp
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=500 * 1024, mode="rb+", dir=scratch.uploads_dir)
+
+app.request_class = ScratchRequest
+
+@app.before_request
+def check_scratch_quota():
+    # Не принимаем большую загрузку, если под неё нет места; резерв держится до конца запроса
+    if request.method == 'POST' and request.content_length:
+        if not scratch.reserve(request.content_length):
+            logger.warning(f"Недостаточно места для загрузки {request.content_length} байт")
+            return admission_error_response(AdmissionRejected(
+                503, "Scratch space quota exhausted", int(SCRATCH_JANITOR_INTERVAL)
+            ))
+        g.scratch_reserved = request.content_length
+
+@app.teardown_request
+def release_scratch_reservation(exc):
+    reserved = g.pop("scratch_reserved", 0)
+    if reserved:
+        scratch.unreserve(reserved)
+
+def parse_diarization_options(form, request_id):
+    """Параметры диакризации из запроса; некорректные значения заменяются значениями по умолчанию."""
+    def number(name, default, low, high):
+        value = form.get(name)
+        if value in (None, ""):
+            return default
+        try:
+            number_value = float(value)
+            if low <= number_value <= high:
+                return number_value
+        except ValueError:
+            pass
+        logger.warning(f"[{request_id}] Некорректный параметр {name}='{value}'. Используем {default}")
+        return default
+
+    mode = form.get('diarization_mode', DIARIZATION_MODE)
+    if mode not in DIARIZATION_MODES:
+        logger.warning(f"[{request_id}] Неизвестный режим диакризации '{mode}'. Используем fixed")
+        mode = "fixed"
+    window_size = number('diarization_window', DIARIZATION_WINDOW, 0.5, 5.0)
+    # Не больше восьми окон на одну длину окна: иначе один запрос занимает encoder надолго
+    min_step = max(0.1, window_size / 8)
+    step_size = number('diarization_step', min(max(DIARIZATION_STEP, min_step), window_size), min_step, window_size)
+    coarse_step = number('diarization_coarse_step', max(DIARIZATION_COARSE_STEP, step_size), step_size, 8 * window_size)
+    return {"mode": mode, "window_size": window_size, "step_size": step_size, "coarse_step": coarse_step}
+
+def diarization_load(options):
+    """Во сколько раз расчёт эмбеддингов дороже профиля по умолчанию.
+
+    Стоимость растёт с длиной окна и числом окон; для адаптивного режима это верхняя граница.
+    """
+    return ((options["window_size"] / options["step_size"])
+            / (DIARIZATION_WINDOW / DIARIZATION_STEP))
+
+def get_client_id():
+    remote_addr = request.remote_addr or "unknown"
+    client_id = request.headers.get("X-Client-Id")
+    if client_id and remote_addr in ADMISSION_TRUSTED_PROXIES:
+        return client_id
+    return remote_addr
+
+def admission_error_response(err, request_id=None):
+    payload = {
+        "error": "Too many requests" if err.status == 429 else "Server busy",
+        "message": err.message,
+        "retry_after": err.retry_after,
+    }
+    if request_id:
+        payload["request_id"] = request_id
+    response = jsonify(payload)
+    response.status_code = err.status
+    response.headers["Retry-After"] = str(err.retry_after)
+    return response
+
+def transcribe_audio(audio_path, model_size="base", language=None, translate=False, backend=None):
+    try:
+        model, backend = get_model(model_size, backend)
         
         task = "translate" if translate else "transcribe"
-        result = model.transcribe(audio_path, word_timestamps=True, language=language, task=task)
+        options = {"fp16": False} if backend == "int8" else {}
+        result = model.transcribe(audio_path, word_timestamps=True, language=language, task=task, **options)
         
         if not result.get("segments"):
             logger.warning(f"Транскрипция не вернула сегменты: {audio_path}")
@@ -214,85 +1121,218 @@ def split_long_segments(segments, max_duration=2.0):
         num_segments = max(1, int(total_duration / max_duration) + 1)
         segment_duration = total_duration / num_segments
         
+        # Слово относится к той части, в которую попадает его середина
+        words = seg.get("words")
+        word_parts = [[] for _ in range(num_segments)]
+        for w in words or []:
+            middle = (w["start"] + w["end"]) / 2
+            part = min(num_segments - 1, max(0, int((middle - start) / segment_duration)))
+            word_parts[part].append(w)
+        
         for i in range(num_segments):
             seg_start = start + i * segment_duration
             seg_end = min(start + (i + 1) * segment_duration, end)
-            split_segs.append({
+            piece = {
                 "start": seg_start,
                 "end": seg_end,
                 "text": text if num_segments == 1 else f"[{i+1}/{num_segments}] {text}"
-            })
+            }
+            if words is not None:
+                piece["words"] = word_parts[i]
+            split_segs.append(piece)
     
     return split_segs
 
-def diarize(audio_path, segments, num_speakers=None):
-    try:
-        wav = preprocess_wav(audio_path)
-        window_size = 1.0
-        step_size = 0.25
-        duration = len(wav) / sampling_rate
-
-        embeddings = []
-        mid_times = []
-
-        # Защита от слишком коротких аудио
-        if duration < window_size:
-            return []
+def _window_embedder(wav, window_size, cancel=None):
+    def embed_at(current_time):
+        if cancel is not None and cancel.is_set():
+            raise StageCancelled("embed")
+        start_sample = int(current_time * sampling_rate)
+        end_sample = int((current_time + window_size) * sampling_rate)
+        
+        if end_sample > len(wav):
+            end_sample = len(wav)
             
-        for current_time in np.arange(0.0, duration - window_size + 0.25, step_size):
-            start_sample = int(current_time * sampling_rate)
-            end_sample = int((current_time + window_size) * sampling_rate)
+        if start_sample >= end_sample:
+            return None
             
-            if end_sample > len(wav):
-                end_sample = len(wav)
-                
-            if start_sample >= end_sample:
-                continue
-                
-            partial = wav[start_sample:end_sample]
+        partial = wav[start_sample:end_sample]
 
-            if partial.size == 0 or np.mean(np.abs(partial)) < 0.001:
-                continue
+        if partial.size == 0 or np.mean(np.abs(partial)) < 0.001:
+            return None
 
-            embed = encoder.embed_utterance(partial)
-            embeddings.append(embed)
-            mid_times.append(current_time + window_size / 2)
+        return encoder.embed_utterance(partial)
+    return embed_at
 
-        if not embeddings:
-            return []
+def _cosine_distance(a, b):
+    return 1.0 - float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-9))
 
-        if num_speakers is None or num_speakers < 1:
-            num_speakers = 2
-        elif num_speakers > 10:
-            num_speakers = 10
+def _adaptive_embeddings(embed_at, last_start, step_size, coarse_step, change_ratio):
+    """Грубый проход с шагом coarse_step и уточнение делением пополам вокруг смен спикера.
 
-        clustering = AgglomerativeClustering(n_clusters=num_speakers).fit(embeddings)
-        labels = clustering.labels_
+    Порог смены — change_ratio медиан расстояний соседних пар грубого прохода вокруг
+    интервала. Все окна лежат на сетке step_size; ключи результата — номера узлов сетки.
+    """
+    points = {}
+    last_index = int(last_start / step_size + 1e-9)
 
-        seg_speakers = []
-        for seg in segments:
-            seg_start, seg_end = seg["start"], seg["end"]
-            seg_labels = []
-            
-            for i, t in enumerate(mid_times):
-                if seg_start <= t <= seg_end:
-                    if i < len(labels):
-                        seg_labels.append(labels[i])
-            
-            if seg_labels:
-                label_counts = Counter(seg_labels)
-                best_label = label_counts.most_common(1)[0][0] if label_counts else None
-            else:
-                best_label = None
+    def embed(index):
+        if index not in points:
+            points[index] = embed_at(index * step_size)
+        return points[index]
 
-            seg_speakers.append((seg_start, seg_end, best_label))
-        
-        logger.info(f"Диакризация успешно завершена для {len(segments)} сегментов")
-        return seg_speakers
-    except Exception as e:
-        logger.error(f"Ошибка диакризации: {str(e)}")
+    def refine(left, right, change_threshold):
+        if right - left <= 1:
+            return
+        middle = (left + right) // 2
+        if embed(middle) is None:
+            # Посередине тишина: сравнить не с чем, проходим интервал мелким шагом
+            for index in range(left + 1, right):
+                embed(index)
+            return
+        if _cosine_distance(points[left], points[middle]) > change_threshold:
+            refine(left, middle, change_threshold)
+        if _cosine_distance(points[middle], points[right]) > change_threshold:
+            refine(middle, right, change_threshold)
+
+    coarse_stride = max(1, int(round(coarse_step / step_size)))
+    coarse_indices = list(range(0, last_index + 1, coarse_stride))
+    if coarse_indices[-1] != last_index:
+        coarse_indices.append(last_index)
+
+    # Соседние непустые окна сравниваем и через паузы: спикер часто меняется после тишины
+    voiced = [index for index in coarse_indices if embed(index) is not None]
+    pairs = list(zip(voiced, voiced[1:]))
+    distances = [_cosine_distance(points[left], points[right]) for left, right in pairs]
+    for position, (left, right) in enumerate(pairs):
+        context = distances[max(0, position - DIARIZATION_CHANGE_CONTEXT):position + DIARIZATION_CHANGE_CONTEXT + 1]
+        change_threshold = change_ratio * float(np.median(context))
+        if distances[position] > change_threshold:
+            refine(left, right, change_threshold)
+
+    return {index * step_size: embedding for index, embedding in points.items() if embedding is not None}
+
+def embed_speaker_windows(audio_path, window_size=DIARIZATION_WINDOW, step_size=DIARIZATION_STEP,
+                          mode="fixed", coarse_step=DIARIZATION_COARSE_STEP,
+                          change_ratio=DIARIZATION_CHANGE_RATIO, cancel=None):
+    """Эмбеддинги голоса по скользящему окну; нужен только звук, без транскрипции.
+
+    cancel — threading.Event: если он установлен, расчёт прерывается между окнами.
+    """
+    wav = preprocess_wav(audio_path)
+    duration = len(wav) / sampling_rate
+
+    # Защита от слишком коротких аудио
+    if duration < window_size:
+        return [], []
+
+    embed_at = _window_embedder(wav, window_size, cancel)
+    if mode == "adaptive":
+        points = _adaptive_embeddings(embed_at, duration - window_size, step_size, coarse_step, change_ratio)
+        full_count = int((duration - window_size) / step_size) + 1
+        logger.info(f"Адаптивная диакризация: {len(points)} эмбеддингов вместо ~{full_count} при фиксированном шаге")
+    else:
+        points = {}
+        for current_time in np.arange(0.0, duration - window_size + step_size, step_size):
+            embed = embed_at(current_time)
+            if embed is not None:
+                points[current_time] = embed
+
+    times = sorted(points)
+    return [points[t] for t in times], [t + window_size / 2 for t in times]
+
+def cluster_speakers(embeddings, num_speakers=None):
+    if not embeddings:
         return []
 
+    if num_speakers is None or num_speakers < 1:
+        num_speakers = 2
+    elif num_speakers > 10:
+        num_speakers = 10
+
+    clustering = AgglomerativeClustering(n_clusters=num_speakers).fit(embeddings)
+    return clustering.labels_
+
+def label_segments(segments, mid_times, labels, max_gap=0.0):
+    """max_gap > 0: сегмент без окон внутри получает метку ближайшего окна не дальше max_gap."""
+    seg_speakers = []
+    for seg in segments:
+        seg_start, seg_end = seg["start"], seg["end"]
+        seg_labels = []
+        
+        for i, t in enumerate(mid_times):
+            if seg_start <= t <= seg_end:
+                if i < len(labels):
+                    seg_labels.append(labels[i])
+        
+        if not seg_labels and max_gap > 0 and len(labels):
+            gaps = [(min(abs(t - seg_start), abs(t - seg_end)), i) for i, t in enumerate(mid_times[:len(labels)])]
+            gap, nearest = min(gaps)
+            if gap <= max_gap:
+                seg_labels.append(labels[nearest])
+        
+        if seg_labels:
+            label_counts = Counter(seg_labels)
+            best_label = label_counts.most_common(1)[0][0] if label_counts else None
+        else:
+            best_label = None
+
+        seg_speakers.append((seg_start, seg_end, best_label))
+    return seg_speakers
+
+class StageError(Exception):
+    def __init__(self, stage, error):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+class StageCancelled(Exception):
+    pass
+
+def run_stage_graph(stages, max_workers=None, cancel=None):
+    """Выполняет граф стадий, запуская каждую, как только готовы её зависимости.
+
+    stages — список (имя, [зависимости], функция); функция получает результаты
+    зависимостей позиционно. Возвращает (результаты, время стадий в секундах).
+    Ошибка стадии выбрасывается как StageError после завершения запущенных стадий;
+    перед этим устанавливается cancel, чтобы длинные стадии могли прерваться.
+    """
+    results = {}
+    timings = {}
+    pending = {name: (deps, fn) for name, deps, fn in stages}
+
+    def timed(name, fn, args):
+        started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            timings[name] = round(time.monotonic() - started, 3)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        running = {}
+        while pending or running:
+            for name, (deps, fn) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    args = [results[dep] for dep in deps]
+                    running[executor.submit(timed, name, fn, args)] = name
+                    del pending[name]
+
+            if not running:
+                raise StageError("graph", f"unresolved dependencies: {sorted(pending)}")
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    pending.clear()
+                    if cancel is not None:
+                        cancel.set()
+                    raise StageError(name, e) from e
+
+    return results, timings
+
 def assign_speakers(segments, diarization):
     assigned_segments = []
     
@@ -325,52 +1365,37 @@ def assign_speakers(segments, diarization):
     
     return assigned_segments
 
+def format_timestamp(t):
+    h, m = divmod(int(t), 3600)
+    m, s = divmod(m, 60)
+    ms = int((t - int(t)) * 1000)
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+def iter_subtitle_content(segments, subtitle_format="srt"):
+    """Потоково отдаёт текст субтитров по одной реплике; segments может быть итератором."""
+    if subtitle_format == "vtt":
+        yield "WEBVTT\n\n"
+
+    for i, seg in enumerate(segments, 1):
+        if "text" not in seg or "start" not in seg or "end" not in seg:
+            continue
+        speaker = seg.get("speaker", "Speaker?")
+
+        if subtitle_format == "srt":
+            yield (f"{i}\n"
+                   f"{format_timestamp(seg['start'])} --> {format_timestamp(seg['end'])}\n"
+                   f"{speaker}: {seg['text']}\n\n")
+        elif subtitle_format == "vtt":
+            start_str = format_timestamp(seg['start']).replace(',', '.')
+            end_str = format_timestamp(seg['end']).replace(',', '.')
+            yield f"{i}\n{start_str} --> {end_str}\n{speaker}: {seg['text']}\n\n"
+        elif subtitle_format == "txt":
+            yield f"{format_timestamp(seg['start'])} - {format_timestamp(seg['end'])}\t{speaker}:\t{seg['text']}\n"
+
 def generate_subtitle_content(segments, subtitle_format="srt"):
-    if not segments:
+    if not segments or subtitle_format not in SUBTITLE_MIMETYPES:
         return ""
-        
-    def format_time(t):
-        h, m = divmod(int(t), 3600)
-        m, s = divmod(m, 60)
-        ms = int((t - int(t)) * 1000)
-        return f"{h:02}:{m:02}:{s:02},{ms:03}"
-    
-    content = ""
-    
-    if subtitle_format == "srt":
-        for i, seg in enumerate(segments, 1):
-            if "text" not in seg or "start" not in seg or "end" not in seg:
-                continue
-                
-            content += f"{i}\n"
-            content += f"{format_time(seg['start'])} --> {format_time(seg['end'])}\n"
-            speaker = seg.get("speaker", "Speaker?")
-            content += f"{speaker}: {seg['text']}\n\n"
-    
-    elif subtitle_format == "vtt":
-        content = "WEBVTT\n\n"
-        for i, seg in enumerate(segments, 1):
-            if "text" not in seg or "start" not in seg or "end" not in seg:
-                continue
-                
-            content += f"{i}\n"
-            start_str = format_time(seg['start']).replace(',', '.')
-            end_str = format_time(seg['end']).replace(',', '.')
-            content += f"{start_str} --> {end_str}\n"
-            speaker = seg.get("speaker", "Speaker?")
-            content += f"{speaker}: {seg['text']}\n\n"
-    
-    elif subtitle_format == "txt":
-        for seg in segments:
-            if "text" not in seg or "start" not in seg or "end" not in seg:
-                continue
-                
-            start_str = format_time(seg['start'])
-            end_str = format_time(seg['end'])
-            speaker = seg.get("speaker", "Speaker?")
-            content += f"{start_str} - {end_str}\t{speaker}:\t{seg['text']}\n"
-    
-    return content
+    return "".join(iter_subtitle_content(segments, subtitle_format))
 
 def generate_video_with_subs_background(video_path, subs_path, output_path, subs_format, language="rus", burn_in=False):
     try:
@@ -380,8 +1405,7 @@ def generate_video_with_subs_background(video_path, subs_path, output_path, subs
                 'ffmpeg',
                 '-i', video_path,
                 '-vf', f"subtitles={os.path.basename(subs_path)}", 
-                '-preset', 'veryfast',  
-                '-crf', '23',          
+                *BURN_IN_VIDEO_ARGS,
                 '-c:a', 'copy',        
                 '-y',                  
                 output_path
@@ -437,6 +1461,436 @@ def generate_video_with_subs_background(video_path, subs_path, output_path, subs
         logger.error(f"Ошибка обработки видео: {str(e)}", exc_info=True)
         return False, str(e)
 
+SRT_TIME_RE = re.compile(r"(\d+):(\d{2}):(\d{2})[,.](\d{3})\s*-->\s*(\d+):(\d{2}):(\d{2})[,.](\d{3})")
+
+def parse_srt_cues(subs_path):
+    """Список реплик (start, end, text) из SRT-файла."""
+    with open(subs_path, 'r', encoding='utf-8') as f:
+        blocks = re.split(r"\n\s*\n", f.read().replace("\r\n", "\n"))
+
+    cues = []
+    for block in blocks:
+        lines = block.strip().split("\n")
+        for i, line in enumerate(lines):
+            match = SRT_TIME_RE.search(line)
+            if match:
+                h1, m1, s1, ms1, h2, m2, s2, ms2 = (int(v) for v in match.groups())
+                start = h1 * 3600 + m1 * 60 + s1 + ms1 / 1000
+                end = h2 * 3600 + m2 * 60 + s2 + ms2 / 1000
+                cues.append((start, end, "\n".join(lines[i + 1:]).strip()))
+                break
+    return cues
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cues_version(cues):
+    return hashlib.blake2b(json.dumps(cues, ensure_ascii=False).encode('utf-8'), digest_size=16).hexdigest()
+
+def changed_time_ranges(old_cues, new_cues, gop_seconds, duration):
+    """Интервалы, выровненные по GOP, покрывающие все добавленные/удалённые/изменённые реплики."""
+    old_counts = Counter(tuple(cue) for cue in old_cues)
+    new_counts = Counter(tuple(cue) for cue in new_cues)
+    changed = list((old_counts - new_counts).elements()) + list((new_counts - old_counts).elements())
+
+    spans = []
+    for start, end, _ in changed:
+        aligned_start = math.floor(start / gop_seconds) * gop_seconds
+        aligned_end = min(duration, math.ceil(max(end, start + 0.001) / gop_seconds) * gop_seconds)
+        if aligned_start < duration:
+            spans.append((aligned_start, aligned_end))
+
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def load_render_cache(media_hash):
+    manifest_path = os.path.join(RENDER_CACHE_DIR, media_hash, "manifest.json")
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        render_path = os.path.join(RENDER_CACHE_DIR, media_hash, manifest["render"])
+        if not os.path.exists(render_path) or manifest.get("gop") != RENDER_GOP_SECONDS:
+            return None
+        manifest["render_path"] = render_path
+        manifest["cues"] = [tuple(cue) for cue in manifest["cues"]]
+        return manifest
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Повреждён кеш рендера {media_hash}: {str(e)}")
+        return None
+
+def store_render_cache(media_hash, output_path, cues, version, duration):
+    entry_dir = os.path.join(RENDER_CACHE_DIR, media_hash)
+    max_bytes = RENDER_CACHE_MAX_MB * 1024 * 1024
+    try:
+        render_size = os.path.getsize(output_path)
+        if render_size > max_bytes:
+            logger.info(f"Рендер ({render_size} байт) больше лимита кеша, не сохраняем")
+            return
+        os.makedirs(entry_dir, exist_ok=True)
+        render_name = f"render-{version}.mp4"
+        render_path = os.path.join(entry_dir, render_name)
+        tmp_path = f"{render_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(output_path, tmp_path)
+        except OSError:
+            # Кеш на другом устройстве: копия занимает место в квоте
+            if not scratch.has_room(render_size):
+                logger.info("Нет места в рабочем пространстве для копии рендера, не сохраняем")
+                return
+            shutil.copyfile(output_path, tmp_path)
+        os.replace(tmp_path, render_path)
+
+        manifest = {"render": render_name, "version": version, "cues": cues,
+                    "duration": duration, "gop": RENDER_GOP_SECONDS, "created": time.time()}
+        manifest_tmp = os.path.join(entry_dir, f"manifest.{uuid.uuid4().hex}.tmp")
+        with open(manifest_tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(manifest_tmp, os.path.join(entry_dir, "manifest.json"))
+
+        # Предыдущие версии рендера этого медиа больше не нужны
+        for name in os.listdir(entry_dir):
+            if name.startswith("render-") and name.endswith(".mp4") and name != render_name:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(entry_dir, name))
+        logger.info(f"Рендер сохранён в кеш: {render_path}")
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить рендер в кеш: {str(e)}")
+        return
+
+    # Вытесняем самые старые записи сверх лимитов по числу и по объёму
+    entries = []
+    for name in os.listdir(RENDER_CACHE_DIR):
+        path = os.path.join(RENDER_CACHE_DIR, name)
+        if os.path.isdir(path):
+            entries.append((os.path.getmtime(path), path, ScratchManager._tree_size(path)))
+    kept = total = 0
+    for _, path, size in sorted(entries, reverse=True):
+        if kept < RENDER_CACHE_MAX_ENTRIES and total + size <= max_bytes:
+            kept += 1
+            total += size
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Запись кеша рендеров вытеснена: {path}")
+
+def plan_video_render(video_path, subs_path, duration):
+    """Решает, как экспортировать видео: reuse / incremental / full."""
+    plan = {"mode": "full", "ranges": [], "media_hash": None, "cues": None, "version": None}
+    try:
+        plan["media_hash"] = file_digest(video_path)
+        plan["cues"] = parse_srt_cues(subs_path)
+        plan["version"] = cues_version(plan["cues"])
+    except Exception as e:
+        logger.warning(f"Не удалось подготовить инкрементальный экспорт: {str(e)}")
+        return plan
+
+    cached = load_render_cache(plan["media_hash"])
+    if not cached or not duration or not plan["cues"]:
+        return plan
+    plan["cached"] = cached
+
+    if cached["version"] == plan["version"]:
+        plan["mode"] = "reuse"
+        return plan
+
+    ranges = changed_time_ranges(cached["cues"], plan["cues"], RENDER_GOP_SECONDS, duration)
+    changed = sum(end - start for start, end in ranges)
+    if changed <= duration * INCREMENTAL_MAX_CHANGED_FRACTION:
+        plan["mode"] = "incremental"
+        plan["ranges"] = ranges
+    logger.info(f"План экспорта: {plan['mode']}, изменено {changed:.1f} из {duration:.1f} с в {len(ranges)} интервалах")
+    return plan
+
+def _run_ffmpeg(command, cwd=None):
+    logger.info(f"Выполняем команду: {subprocess.list2cmdline(command)}")
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd)
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg error (код {result.returncode}): {result.stderr[-500:]}")
+
+def render_incremental(video_path, subs_path, output_path, cached_render_path, ranges, duration):
+    """Перекодирует только изменённые интервалы и склеивает их с копией прежнего рендера."""
+    work_dir = os.path.join(os.path.dirname(output_path), "incremental")
+    os.makedirs(work_dir, exist_ok=True)
+
+    boundaries = sorted({t for span in ranges for t in span if 0 < t < duration})
+    points = [0.0] + boundaries + [duration]
+
+    # Режем прежний рендер по ключевым кадрам без перекодирования
+    split_command = ['ffmpeg', '-i', cached_render_path, '-map', '0:v:0', '-c', 'copy']
+    if boundaries:
+        split_command += ['-f', 'segment', '-segment_format', 'mp4',
+                          '-segment_format_options', 'video_track_timescale=90000',
+                          '-segment_times', ",".join(f"{t:.3f}" for t in boundaries),
+                          '-reset_timestamps', '1', '-y', os.path.join(work_dir, "old_%05d.mp4")]
+    else:
+        split_command += ['-video_track_timescale', '90000', '-y', os.path.join(work_dir, "old_00000.mp4")]
+    _run_ffmpeg(split_command)
+
+    # Перекодируем изменённые интервалы из исходника с новыми субтитрами
+    subs_name = os.path.basename(subs_path)
+    new_parts = {}
+    for i, (start, end) in enumerate(ranges):
+        part_path = os.path.join(work_dir, f"new_{i:05d}.mp4")
+        _run_ffmpeg([
+            'ffmpeg',
+            '-ss', f"{start:.3f}",
+            '-i', video_path,
+            '-t', f"{end - start:.3f}",
+            '-map', '0:v:0',
+            '-an',
+            '-vf', f"setpts=PTS+{start:.3f}/TB,subtitles={subs_name},setpts=PTS-STARTPTS",
+            *BURN_IN_VIDEO_ARGS,
+            '-y', part_path
+        ], cwd=os.path.dirname(subs_path))
+        new_parts[start] = part_path
+
+    concat_list = os.path.join(work_dir, "concat.txt")
+    with open(concat_list, 'w', encoding='utf-8') as f:
+        for i in range(len(points) - 1):
+            start, end = points[i], points[i + 1]
+            if any(r_start <= start and end <= r_end for r_start, r_end in ranges):
+                if start in new_parts:
+                    f.write(f"file '{new_parts[start]}'\n")
+            else:
+                f.write(f"file '{os.path.join(work_dir, f'old_{i:05d}.mp4')}'\n")
+
+    # Склеиваем видео и возвращаем исходную звуковую дорожку целиком
+    _run_ffmpeg([
+        'ffmpeg',
+        '-f', 'concat', '-safe', '0', '-i', concat_list,
+        '-i', video_path,
+        '-map', '0:v:0',
+        '-map', '1:a:0?',
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-y', output_path
+    ])
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return output_path
+
+def render_job_duration(plan, duration):
+    """Эквивалентная длительность экспорта для контроля допуска.
+
+    Перекодируются только изменённые интервалы, но нарезка и склейка
+    прежнего рендера тоже растут с длиной видео.
+    """
+    if plan["mode"] == "full" or not duration:
+        return duration
+    encoded = sum(end - start for start, end in plan["ranges"])
+    if encoded:
+        encoded += RENDER_GOP_SECONDS
+    return encoded + duration * INCREMENTAL_COPY_FACTOR
+
+def execute_render_plan(plan, video_path, subs_path, output_path, language, duration):
+    """Выполняет план экспорта.
+
+    Если reuse/incremental не удались (например, рендер успели вытеснить
+    из кеша), план переводится в full и возвращается (None, None): полный
+    рендер нужно допустить заново с полной длительностью.
+    """
+    if plan["mode"] in ("reuse", "incremental"):
+        try:
+            if plan["mode"] == "reuse":
+                shutil.copyfile(plan["cached"]["render_path"], output_path)
+                logger.info("Субтитры не изменились, используется сохранённый рендер")
+            else:
+                render_incremental(video_path, subs_path, output_path,
+                                   plan["cached"]["render_path"], plan["ranges"], duration)
+                store_render_cache(plan["media_hash"], output_path, plan["cues"], plan["version"], duration)
+            return True, output_path
+        except Exception as e:
+            logger.warning(f"Экспорт в режиме {plan['mode']} не удался, нужен полный: {str(e)}")
+            plan["mode"] = "full"
+            plan["ranges"] = []
+            return None, None
+
+    success, result = generate_video_with_subs_background(
+        video_path=video_path,
+        subs_path=subs_path,
+        output_path=output_path,
+        subs_format='srt',
+        language=language,
+        burn_in=True
+    )
+    if success and plan["media_hash"] and plan["cues"]:
+        store_render_cache(plan["media_hash"], output_path, plan["cues"], plan["version"], duration)
+    return success, result
+
+def segment_rows(segments, speakers, with_words=False):
+    """Компактные строки [start, end, индекс спикера, text(, words)]; speakers дополняется по ходу."""
+    speaker_index = {name: i for i, name in enumerate(speakers)}
+    for seg in segments:
+        speaker = seg.get("speaker", "Speaker?")
+        if speaker not in speaker_index:
+            speaker_index[speaker] = len(speakers)
+            speakers.append(speaker)
+        row = [round(seg["start"], 3), round(seg["end"], 3), speaker_index[speaker], seg["text"]]
+        if with_words:
+            row.append([[round(w["start"], 3), round(w["end"], 3), w["word"]] for w in seg.get("words", [])])
+        yield row
+
+def rows_to_segments(rows, speakers):
+    for row in rows:
+        yield {"start": row[0], "end": row[1], "speaker": speakers[row[2]], "text": row[3]}
+
+def store_segment_result(segments, with_words, meta):
+    """Сохраняет сегменты в рабочий каталог (по строке JSON на сегмент) для постраничной выдачи."""
+    result_dir = scratch.create("result", ttl=RESULTS_TTL, detached=True)
+    speakers = []
+    with open(os.path.join(result_dir, "segments.jsonl"), 'w', encoding='utf-8') as f:
+        for row in segment_rows(segments, speakers, with_words):
+            f.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+    meta = dict(meta, speakers=speakers, with_words=with_words, segments_count=len(segments))
+    with open(os.path.join(result_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return os.path.basename(result_dir), meta
+
+def load_segment_result(result_id):
+    if not result_id.startswith("result-"):
+        return None, None
+    result_dir = scratch.path_for(result_id)
+    if not result_dir:
+        return None, None
+    try:
+        with open(os.path.join(result_dir, "meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    scratch.extend(result_dir, RESULTS_TTL)
+    return result_dir, meta
+
+def encode_cursor(result_id, index, offset):
+    raw = json.dumps([result_id, index, offset]).encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip("=")
+
+def decode_cursor(cursor, result_id):
+    """Курсор хранит id результата, номер сегмента и байтовое смещение строки в segments.jsonl."""
+    if not cursor:
+        return 0, 0
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_result_id, index, offset = json.loads(raw)
+        if cursor_result_id != result_id or int(index) < 0 or int(offset) < 0:
+            raise ValueError(cursor)
+        return int(index), int(offset)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+class SegmentPage:
+    """Страница строк из segments.jsonl, читаемая лениво; limit=0 — до конца файла."""
+
+    def __init__(self, result_dir, cursor, limit):
+        self.result_id = os.path.basename(result_dir)
+        self.path = os.path.join(result_dir, "segments.jsonl")
+        self.index, self.offset = decode_cursor(cursor, self.result_id)
+        self.limit = limit
+        self.next_cursor = None
+        # Смещение проверяется до начала ответа: ошибка внутри потока обрезала бы тело
+        if self.offset:
+            with open(self.path, 'rb') as f:
+                if self.offset > os.fstat(f.fileno()).st_size:
+                    raise ValueError(f"Invalid cursor: {cursor}")
+                f.seek(self.offset - 1)
+                if f.read(1) != b"\n":
+                    raise ValueError(f"Invalid cursor: {cursor}")
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            count = 0
+            while True:
+                position = f.tell()
+                line = f.readline()
+                if not line:
+                    return
+                if self.limit and count >= self.limit:
+                    self.next_cursor = encode_cursor(self.result_id, self.index + count, position)
+                    return
+                count += 1
+                yield json.loads(line)
+
+def parse_page_size(value, default=SEGMENTS_PAGE_SIZE):
+    if value in (None, ""):
+        return default
+    if value == "all":
+        return 0
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError(f"Invalid page size: {value}")
+    return min(page_size, SEGMENTS_MAX_PAGE_SIZE)
+
+MSGPACK_MIMETYPES = ("application/x-msgpack", "application/msgpack")
+
+def segments_format():
+    """"json" или "msgpack" по заголовку Accept с учётом q; None — подходит только недоступный формат."""
+    accept = request.accept_mimetypes
+    offered = ["application/json"] + (list(MSGPACK_MIMETYPES) if msgpack is not None else [])
+    best = accept.best_match(offered)
+    if best in MSGPACK_MIMETYPES:
+        return "msgpack"
+    if best is None and any(accept[mimetype] for mimetype in MSGPACK_MIMETYPES):
+        return None
+    return "json"
+
+def not_acceptable_response(**ids):
+    return jsonify(dict({
+        "error": "Not acceptable",
+        "message": "Segments are available as application/json"
+                   + (" or application/x-msgpack" if msgpack is not None else ""),
+    }, **ids)), 406
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_json_page(header, page):
+    """Сериализует страницу по частям: заголовок, сегменты пачками, затем next_cursor."""
+    yield json.dumps(header, ensure_ascii=False)[:-1] + ', "segments": ['
+    batch = []
+    first = True
+    for row in page:
+        batch.append(json.dumps(row, ensure_ascii=False, separators=(",", ":")))
+        if len(batch) >= STREAM_CHUNK_SEGMENTS:
+            yield ("" if first else ",") + ",".join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ("" if first else ",") + ",".join(batch)
+    yield f'], "next_cursor": {json.dumps(page.next_cursor)}}}'
+
+def negotiated_response(chunks, mimetype):
+    """Потоковый ответ; сжимается gzip, если клиент это поддерживает."""
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if request.accept_encodings["gzip"] > 0:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+def segments_page_response(header, page):
+    if segments_format() == "msgpack":
+        # msgpack собирается в памяти целиком, поэтому страница всегда ограничена
+        if not page.limit or page.limit > SEGMENTS_MAX_PAGE_SIZE:
+            page.limit = SEGMENTS_MAX_PAGE_SIZE
+        payload = dict(header, segments=list(page))
+        payload["next_cursor"] = page.next_cursor
+        return negotiated_response([msgpack.packb(payload, use_bin_type=True)], "application/x-msgpack")
+    return negotiated_response(iter_json_page(header, page), "application/json")
+
 @app.route('/generate-subtitles', methods=['POST'])
 def generate_subtitles():
     request_id = uuid.uuid4().hex
@@ -472,6 +1926,16 @@ def generate_subtitles():
         
         # Загрузка параметров из формы
         model_size = request.form.get('model_size', 'base')
+        # Бэкенд можно задать отдельно или суффиксом: model_size=base-int8
+        size, backend, model_size = resolve_model_key(model_size, request.form.get('backend'))
+        if size not in whisper.available_models():
+            logger.error(f"[{request_id}] Неизвестная модель Whisper: {size}")
+            return jsonify({
+                "error": "Invalid parameter",
+                "message": f"Unknown model size: {size}",
+                "supported": whisper.available_models(),
+                "request_id": request_id
+            }), 400
         language = request.form.get('language', 'ru')
         
         if language == 'auto':
@@ -484,13 +1948,30 @@ def generate_subtitles():
         translate = request.form.get('translate', 'false').lower() == 'true'
         subtitle_format = request.form.get('format', 'srt')
         num_speakers = request.form.get('num_speakers')
+        # "content" — весь файл субтитров строкой, "segments" — постраничный массив сегментов
+        response_format = request.form.get('response_format', 'content')
+        if response_format == "segments" and segments_format() is None:
+            return not_acceptable_response(request_id=request_id)
+        diarization_options = parse_diarization_options(request.form, request_id)
+        word_timings = request.form.get('word_timings', 'false').lower() == 'true'
+        try:
+            page_size = parse_page_size(request.form.get('page_size'))
+        except ValueError as e:
+            return jsonify({
+                "error": "Invalid parameter",
+                "message": str(e),
+                "request_id": request_id
+            }), 400
         
         logger.info(f"[{request_id}] Параметры запроса:")
         logger.info(f"  model_size: {model_size}")
+        logger.info(f"  backend: {backend}")
         logger.info(f"  language: {language}")
         logger.info(f"  translate: {translate}")
         logger.info(f"  subtitle_format: {subtitle_format}")
         logger.info(f"  num_speakers: {num_speakers}")
+        logger.info(f"  response_format: {response_format}")
+        logger.info(f"  diarization: {diarization_options}")
         
         # Конвертация параметров числовых значений
         if num_speakers:
@@ -536,108 +2017,33 @@ def generate_subtitles():
             }), 400
         
         # Работа с временным каталогом
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with scratch.workspace("subs") as temp_dir:
             logger.info(f"[{request_id}] Создан временный каталог: {temp_dir}")
             
-            # Создаем путь для аудиофайла
-            audio_path = os.path.join(temp_dir, "audio.wav")
-            logger.info(f"[{request_id}] Путь для аудиофайла: {audio_path}")
+            video_path = os.path.join(temp_dir, f"input.{file_extension}")
+            video_file.save(video_path)
+            logger.info(f"[{request_id}] Видеофайл сохранён: {video_path}")
             
-            # Извлечение аудио
-            try:
-                extract_audio(video_file, audio_path)
-                
-                # Проверка существования аудиофайла
-                if not os.path.exists(audio_path) or os.path.getsize(audio_path) < 1024:
-                    error_msg = "Failed to extract valid audio from video"
-                    logger.error(f"[{request_id}] {error_msg}")
-                    return jsonify({
-                        "error": "Audio extraction error",
-                        "message": "Could not extract valid audio from video file",
-                        "request_id": request_id
-                    }), 400
-            except Exception as audio_err:
-                logger.error(f"[{request_id}] Ошибка извлечения аудио: {str(audio_err)}")
-                return jsonify({
-                    "error": "Processing error",
-                    "message": "Failed to process video file",
-                    "details": str(audio_err),
-                    "request_id": request_id
-                }), 500
-            
-            # Транскрипция аудио
-            try:
-                segments = transcribe_audio(audio_path, model_size, language, translate)
-                logger.info(f"[{request_id}] Получено {len(segments)} транскрибированных сегментов")
-                
-                if not segments:
-                    error_msg = "No transcribed segments returned"
-                    logger.error(f"[{request_id}] {error_msg}")
-                    return jsonify({
-                        "error": "Transcription failed",
-                        "message": "Audio transcription returned no segments",
-                        "request_id": request_id
-                    }), 500
-                    
-                segments = split_long_segments(segments)
-            except Exception as transcribe_err:
-                logger.error(f"[{request_id}] Ошибка транскрипции: {str(transcribe_err)}")
-                return jsonify({
-                    "error": "Transcription error",
-                    "message": "Failed to transcribe audio",
-                    "details": str(transcribe_err),
-                    "request_id": request_id
-                }), 500
-            
-            # Диакризация
-            diarization = []
-            duration = max(segment["end"] for segment in segments) if segments else 0
+            media_duration = probe_media_duration(video_path)
+            logger.info(f"[{request_id}] Длительность медиа: {media_duration}")
             
+            # Место под извлечённый WAV
+            scratch_bytes = (media_duration or ADMISSION_UNKNOWN_DURATION) * SCRATCH_AUDIO_BYTES_PER_SECOND
             try:
-                if duration > 10:
-                    diarization = diarize(audio_path, segments, num_speakers)
-                    logger.info(f"[{request_id}] Диакризация завершена: {len(diarization)} результатов")
-                else:
-                    logger.info(f"[{request_id}] Пропуск диакризации для короткого видео")
-            except Exception as diarize_err:
-                logger.error(f"[{request_id}] Ошибка диакризации: {str(diarize_err)}")
-                diarization = []
-            
-            try:
-                segments = assign_speakers(segments, diarization)
-                subtitle_content = generate_subtitle_content(segments, subtitle_format)
-                
-                if not subtitle_content:
-                    error_msg = "Generated subtitles are empty"
-                    logger.error(f"[{request_id}] {error_msg}")
-                    return jsonify({
-                        "error": "Subtitles generation failed",
-                        "message": "Generated subtitles content is empty",
-                        "request_id": request_id
-                    }), 500
-                    
-                logger.info(f"[{request_id}] Успешно сгенерированы субтитры ({len(subtitle_content)} символов)")
-                
-                return jsonify({
-                    "success": True,
-                    "duration": f"{duration:.2f} seconds",
-                    "segments_count": len(segments),
-                    "format": subtitle_format,
-                    "content": subtitle_content,
-                    "speakers": (num_speakers if num_speakers else "auto"),
-                    "file_type": file_type,
-                    "file_extension": file_extension,
-                    "request_id": request_id
-                })
-                
-            except Exception as gen_err:
-                logger.error(f"[{request_id}] Ошибка генерации субтитров: {str(gen_err)}")
-                return jsonify({
-                    "error": "Subtitles generation error",
-                    "message": "Failed to generate subtitles content",
-                    "details": str(gen_err),
-                    "request_id": request_id
-                }), 500
+                with admission.admit(get_client_id(), model_size, media_duration, scratch_bytes,
+                                     diarization_load(diarization_options)) as job:
+                    started = time.monotonic()
+                    response = app.make_response(process_subtitles_request(
+                        request_id, video_path, temp_dir, model_size, language, translate,
+                        subtitle_format, num_speakers, file_type, file_extension,
+                        response_format, word_timings, page_size, diarization_options
+                    ))
+                    if response.status_code == 200:
+                        admission.observe(job, time.monotonic() - started)
+                    return response
+            except AdmissionRejected as rejected:
+                logger.warning(f"[{request_id}] Задача отклонена ({rejected.status}): {rejected.message}")
+                return admission_error_response(rejected, request_id)
                 
     except Exception as e:
         logger.error(f"[{request_id}] Критическая ошибка обработки: {str(e)}", exc_info=True)
@@ -647,6 +2053,181 @@ def generate_subtitles():
             "request_id": request_id
         }), 500
 
+def process_subtitles_request(request_id, video_path, temp_dir, model_size, language, translate,
+                              subtitle_format, num_speakers, file_type, file_extension,
+                              response_format="content", word_timings=False, page_size=SEGMENTS_PAGE_SIZE,
+                              diarization_options=None):
+    # Создаем путь для аудиофайла
+    audio_path = os.path.join(temp_dir, "audio.wav")
+    logger.info(f"[{request_id}] Путь для аудиофайла: {audio_path}")
+    
+    # Извлечение аудио
+    timings = {}
+    started = time.monotonic()
+    try:
+        extract_audio(video_path, audio_path)
+        timings["extract_audio"] = round(time.monotonic() - started, 3)
+        
+        # Проверка существования аудиофайла
+        if not os.path.exists(audio_path) or os.path.getsize(audio_path) < 1024:
+            error_msg = "Failed to extract valid audio from video"
+            logger.error(f"[{request_id}] {error_msg}")
+            return jsonify({
+                "error": "Audio extraction error",
+                "message": "Could not extract valid audio from video file",
+                "request_id": request_id
+            }), 400
+    except Exception as audio_err:
+        logger.error(f"[{request_id}] Ошибка извлечения аудио: {str(audio_err)}")
+        return jsonify({
+            "error": "Processing error",
+            "message": "Failed to process video file",
+            "details": str(audio_err),
+            "request_id": request_id
+        }), 500
+    
+    # Транскрипция и эмбеддинги голосов выполняются параллельно;
+    # разметка спикеров ждёт обе ветки
+    run_diarization = wav_duration(audio_path) > 10
+    diarization_options = diarization_options or {}
+    if not run_diarization:
+        logger.info(f"[{request_id}] Пропуск диакризации для короткого видео")
+
+    # Ошибка транскрипции прерывает расчёт эмбеддингов, а не ждёт его окончания
+    cancel = threading.Event()
+
+    def embed_stage():
+        if not run_diarization:
+            return [], []
+        try:
+            return embed_speaker_windows(audio_path, cancel=cancel, **diarization_options)
+        except StageCancelled:
+            raise
+        except Exception as diarize_err:
+            logger.error(f"[{request_id}] Ошибка диакризации: {str(diarize_err)}")
+            return [], []
+
+    def cluster_stage(windows):
+        try:
+            return cluster_speakers(windows[0], num_speakers)
+        except Exception as diarize_err:
+            logger.error(f"[{request_id}] Ошибка диакризации: {str(diarize_err)}")
+            return []
+
+    def assign_stage(segments, windows, labels):
+        max_gap = diarization_options["coarse_step"] if diarization_options.get("mode") == "adaptive" else 0.0
+        diarization = label_segments(segments, windows[1], labels, max_gap) if len(labels) else []
+        logger.info(f"[{request_id}] Диакризация завершена: {len(diarization)} результатов")
+        return assign_speakers(segments, diarization)
+
+    try:
+        results, stage_timings = run_stage_graph([
+            ("transcribe", [], lambda: transcribe_audio(audio_path, model_size, language, translate)),
+            ("split", ["transcribe"], split_long_segments),
+            ("embed", [], embed_stage),
+            ("cluster", ["embed"], cluster_stage),
+            ("assign", ["split", "embed", "cluster"], assign_stage),
+        ], cancel=cancel)
+        timings.update(stage_timings)
+        logger.info(f"[{request_id}] Время стадий: {timings}")
+    except StageError as stage_err:
+        if stage_err.stage in ("transcribe", "split"):
+            logger.error(f"[{request_id}] Ошибка транскрипции: {str(stage_err.error)}")
+            return jsonify({
+                "error": "Transcription error",
+                "message": "Failed to transcribe audio",
+                "details": str(stage_err.error),
+                "request_id": request_id
+            }), 500
+        logger.error(f"[{request_id}] Ошибка генерации субтитров: {str(stage_err.error)}")
+        return jsonify({
+            "error": "Subtitles generation error",
+            "message": "Failed to generate subtitles content",
+            "details": str(stage_err.error),
+            "request_id": request_id
+        }), 500
+
+    logger.info(f"[{request_id}] Получено {len(results['transcribe'])} транскрибированных сегментов")
+    if not results["transcribe"]:
+        error_msg = "No transcribed segments returned"
+        logger.error(f"[{request_id}] {error_msg}")
+        return jsonify({
+            "error": "Transcription failed",
+            "message": "Audio transcription returned no segments",
+            "request_id": request_id
+        }), 500
+
+    segments = results["assign"]
+    duration = max(segment["end"] for segment in segments) if segments else 0
+    
+    if response_format == "segments":
+        try:
+            result_id, meta = store_segment_result(segments, word_timings, {
+                "format": subtitle_format,
+                "duration": round(duration, 3),
+            })
+            result_dir = scratch.path_for(result_id)
+            logger.info(f"[{request_id}] Сегменты сохранены для постраничной выдачи: {result_id}")
+        except Exception as gen_err:
+            logger.error(f"[{request_id}] Ошибка сохранения сегментов: {str(gen_err)}")
+            return jsonify({
+                "error": "Subtitles generation error",
+                "message": "Failed to store subtitle segments",
+                "details": str(gen_err),
+                "request_id": request_id
+            }), 500
+
+        return segments_page_response({
+            "success": True,
+            "result_id": result_id,
+            "duration": f"{duration:.2f} seconds",
+            "segments_count": len(segments),
+            "format": subtitle_format,
+            "fields": ["start", "end", "speaker", "text"] + (["words"] if word_timings else []),
+            "speakers": meta["speakers"],
+            "num_speakers": (num_speakers if num_speakers else "auto"),
+            "file_type": file_type,
+            "file_extension": file_extension,
+            "timings": timings,
+            "request_id": request_id
+        }, SegmentPage(result_dir, None, page_size))
+
+    try:
+        subtitle_content = generate_subtitle_content(segments, subtitle_format)
+        
+        if not subtitle_content:
+            error_msg = "Generated subtitles are empty"
+            logger.error(f"[{request_id}] {error_msg}")
+            return jsonify({
+                "error": "Subtitles generation failed",
+                "message": "Generated subtitles content is empty",
+                "request_id": request_id
+            }), 500
+            
+        logger.info(f"[{request_id}] Успешно сгенерированы субтитры ({len(subtitle_content)} символов)")
+        
+        return jsonify({
+            "success": True,
+            "duration": f"{duration:.2f} seconds",
+            "segments_count": len(segments),
+            "format": subtitle_format,
+            "content": subtitle_content,
+            "speakers": (num_speakers if num_speakers else "auto"),
+            "file_type": file_type,
+            "file_extension": file_extension,
+            "timings": timings,
+            "request_id": request_id
+        })
+        
+    except Exception as gen_err:
+        logger.error(f"[{request_id}] Ошибка генерации субтитров: {str(gen_err)}")
+        return jsonify({
+            "error": "Subtitles generation error",
+            "message": "Failed to generate subtitles content",
+            "details": str(gen_err),
+            "request_id": request_id
+        }), 500
+
 @app.route('/generate-video-with-subs', methods=['POST'])
 def generate_video_with_subs():
     temp_dir = None
@@ -657,9 +2238,7 @@ def generate_video_with_subs():
         language = request.form.get('language', 'rus')
         filename = secure_filename(video_file.filename)
         
-        burn_in = True  
-        
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = scratch.create("export")
         logger.info(f"Создан временный каталог: {temp_dir}")
         
         base_filename = os.path.splitext(filename)[0]
@@ -688,6 +2267,7 @@ def generate_video_with_subs():
                 logger.info(f"Субтитры сконвертированы в SRT")
             except Exception as conv_err:
                 logger.error(f"Ошибка конвертации субтитров: {str(conv_err)}")
+                scratch.release(temp_dir)
                 return jsonify({
                     "error": "Subtitles conversion failed",
                     "details": str(conv_err)
@@ -702,16 +2282,29 @@ def generate_video_with_subs():
         output_filename = f"{safe_base}_with_hardcoded_subs.mp4"
         output_path = os.path.join(temp_dir, output_filename)
         
-        success, result_path = generate_video_with_subs_background(
-            video_path=video_path,
-            subs_path=subs_path,
-            output_path=output_path,
-            subs_format='srt',  
-            language=language,
-            burn_in=burn_in
-        )
+        media_duration = probe_media_duration(video_path)
+        plan = plan_video_render(video_path, subs_path, media_duration)
+        try:
+            # Выходное видео и промежуточные куски — порядка размера исходника
+            scratch_bytes = 2 * os.path.getsize(video_path)
+            success = None
+            while success is None:
+                job_duration = render_job_duration(plan, media_duration)
+                with admission.admit(get_client_id(), "burn_in", job_duration, scratch_bytes) as job:
+                    started = time.monotonic()
+                    success, result_path = execute_render_plan(
+                        plan, video_path, subs_path, output_path, language, media_duration
+                    )
+                    # Коэффициент burn_in уточняется только по полным рендерам
+                    if success and plan["mode"] == "full":
+                        admission.observe(job, time.monotonic() - started)
+        except AdmissionRejected as rejected:
+            logger.warning(f"Экспорт видео отклонён ({rejected.status}): {rejected.message}")
+            scratch.release(temp_dir)
+            return admission_error_response(rejected)
         
         if not success:
+            scratch.release(temp_dir)
             return jsonify({"error": result_path}), 500
         
         response = send_file(
@@ -721,35 +2314,244 @@ def generate_video_with_subs():
             mimetype='video/mp4'
         )
         
-        delayed_delete(temp_dir)
+        response.call_on_close(lambda: scratch.release(temp_dir))
         return response
 
     except Exception as e:
         logger.error(f"Ошибка в generate-video: {str(e)}", exc_info=True)
         if temp_dir:
-            delayed_delete(temp_dir)
+            scratch.release(temp_dir)
         return jsonify({
             "error": "Internal server error",
             "details": str(e)
         }), 500
 
+@app.route('/subtitles/<result_id>/segments', methods=['GET'])
+def get_subtitle_segments(result_id):
+    result_dir, meta = load_segment_result(result_id)
+    if not result_dir:
+        return jsonify({
+            "error": "Result not found",
+            "message": "Subtitle result expired or does not exist",
+            "result_id": result_id
+        }), 404
+    if segments_format() is None:
+        return not_acceptable_response(result_id=result_id)
+
+    try:
+        page_size = parse_page_size(request.args.get('limit'))
+        page = SegmentPage(result_dir, request.args.get('cursor'), page_size)
+    except ValueError as e:
+        return jsonify({
+            "error": "Invalid parameter",
+            "message": str(e),
+            "result_id": result_id
+        }), 400
+
+    return segments_page_response({
+        "success": True,
+        "result_id": result_id,
+        "segments_count": meta["segments_count"],
+        "fields": ["start", "end", "speaker", "text"] + (["words"] if meta["with_words"] else []),
+        "speakers": meta["speakers"]
+    }, page)
+
+@app.route('/subtitles/<result_id>/content', methods=['GET'])
+def get_subtitle_content(result_id):
+    result_dir, meta = load_segment_result(result_id)
+    if not result_dir:
+        return jsonify({
+            "error": "Result not found",
+            "message": "Subtitle result expired or does not exist",
+            "result_id": result_id
+        }), 404
+
+    subtitle_format = request.args.get('format', meta.get("format", "srt"))
+    if subtitle_format not in SUBTITLE_MIMETYPES:
+        return jsonify({
+            "error": "Invalid parameter",
+            "message": f"Unsupported subtitle format: {subtitle_format}",
+            "result_id": result_id
+        }), 400
+
+    segments = rows_to_segments(SegmentPage(result_dir, None, 0), meta["speakers"])
+    response = negotiated_response(iter_subtitle_content(segments, subtitle_format),
+                                   SUBTITLE_MIMETYPES[subtitle_format])
+    response.headers["Content-Disposition"] = f"attachment; filename=subtitles.{subtitle_format}"
+    return response
+
 @app.route('/health', methods=['GET'])
 def health_check():
     models_loaded = []
     for model_size, model in models.items():
         models_loaded.append({
             "size": model_size,
+            "backend": resolve_model_key(model_size)[1],
+            "experimental": resolve_model_key(model_size)[1] == "int8",
             "loaded": model is not None
         })
     
     return jsonify({
         "status": "OK",
         "models_loaded": models_loaded,
+        "admission": admission.stats(),
+        "scratch": scratch.stats(),
+        "torch_threads": {
+            "intra_op": torch.get_num_threads(),
+            "inter_op": torch.get_num_interop_threads()
+        },
         "python_environment": {
             "whisper_version": whisper.__version__ if hasattr(whisper, '__version__') else "unknown"
         }
     })
 
+def _run_worker(server, worker_index, num_workers):
+    state = {"stopping": False, "handled": 0}
+
+    def stop(signum, frame):
+        state["stopping"] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+
+    cpu_count = os.cpu_count() or 1
+    configure_torch_threads(TORCH_THREADS or max(1, cpu_count // num_workers), TORCH_INTEROP_THREADS)
+    # Рабочие каталоги убирает уборщик мастера
+    scratch.janitor_enabled = False
+
+    # Неблокирующий accept: соединение может забрать другой воркер, поэтому
+    # готовность сокета ждём сами, а не через handle_request() — с неблокирующим
+    # сокетом его select не ждёт вовсе. При остановке дожидаемся потоков запросов.
+    server.socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server.socket, selectors.EVENT_READ)
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    process_request = server.process_request
+
+    def counting_process_request(request, client_address):
+        state["handled"] += 1
+        process_request(request, client_address)
+
+    server.process_request = counting_process_request
+
+    started = time.monotonic()
+    logger.info(f"Воркер {worker_index} (pid {os.getpid()}) запущен")
+    while not state["stopping"]:
+        if selector.select(1.0):
+            server._handle_request_noblock()
+        if WORKER_MAX_REQUESTS and state["handled"] >= WORKER_MAX_REQUESTS:
+            logger.info(f"Воркер {worker_index} обработал {state['handled']} запросов, перезапуск")
+            break
+        if WORKER_MAX_AGE and time.monotonic() - started >= WORKER_MAX_AGE:
+            logger.info(f"Воркер {worker_index} достиг максимального времени жизни, перезапуск")
+            break
+
+    selector.close()
+    server.server_close()
+    logger.info(f"Воркер {worker_index} (pid {os.getpid()}) остановлен")
+
+MASTER_SIGNALS = {signal.SIGTERM, signal.SIGINT, signal.SIGHUP} if hasattr(signal, "SIGHUP") else set()
+
+def serve_prefork(host, port, num_workers):
+    """Мастер-процесс: слушает порт, порождает воркеров и перезапускает их.
+
+    Модели уже загружены при импорте модуля, поэтому воркеры получают их
+    через fork() и разделяют страницы с весами copy-on-write. SIGTERM/SIGINT
+    останавливают сервер, SIGHUP плавно перезапускает всех воркеров.
+    Контроль допуска общий для всех воркеров: его состояние создано до fork()
+    в разделяемой памяти, а задачи упавшего воркера мастер освобождает сам.
+    """
+    server = make_server(host, port, app, threaded=True)
+    # Убираем загруженные объекты из-под сборщика мусора, чтобы он не
+    # трогал их заголовки в воркерах и не разрушал разделение страниц
+    gc.freeze()
+    scratch.start_janitor()
+
+    workers = {}
+    retiring = set()
+    state = {"stopping": False}
+
+    def spawn(worker_index):
+        # Сигналы блокируются на время fork(), пока воркер не установит свои обработчики
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                _run_worker(server, worker_index, num_workers)
+            except Exception:
+                logger.error(f"Воркер {worker_index} аварийно завершился", exc_info=True)
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+        workers[pid] = worker_index
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        return pid
+
+    def stop(signum, frame):
+        state["stopping"] = True
+        for pid in list(workers):
+            _signal_worker(pid, signal.SIGTERM)
+
+    def recycle(signum, frame):
+        logger.info("Плавный перезапуск воркеров")
+        for pid, worker_index in list(workers.items()):
+            if pid in retiring:
+                continue
+            retiring.add(pid)
+            _signal_worker(pid, signal.SIGTERM)
+            spawn(worker_index)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, recycle)
+
+    logger.info(f"Prefork-сервер на {host}:{port}, воркеров: {num_workers}")
+    for worker_index in range(num_workers):
+        spawn(worker_index)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_index = workers.pop(pid, None)
+        if worker_index is None:
+            continue
+        admission.release_process(pid)
+        scratch.release_process(pid)
+        if pid in retiring:
+            retiring.discard(pid)
+            continue
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+            logger.warning(f"Воркер {worker_index} (pid {pid}) завершился со статусом {status}")
+            # Не перезапускаем в цикле без паузы, если воркер падает сразу
+            time.sleep(1)
+        if not state["stopping"]:
+            spawn(worker_index)
+
+    server.server_close()
+    logger.info("Prefork-сервер остановлен")
+
+def _signal_worker(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
 if __name__ == '__main__':
-    logger.info("Запуск Flask сервера...")
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
\ No newline at end of file
+    if SERVER_MODE == "prefork" and hasattr(os, "fork"):
+        serve_prefork(SERVER_HOST, SERVER_PORT, SERVER_WORKERS)
+    elif SERVER_MODE == "prefork":
+        logger.warning("fork() недоступен на этой платформе, запускаем однопроцессный сервер")
+        scratch.start_janitor()
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False, threaded=True)
+    else:
+        logger.info("Запуск Flask сервера...")
+        scratch.start_janitor()
+        app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
\ No newline at end of file